@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+
+"""
+seeds a new database and measures the API through the flask test client with several threads,
+discord and mailjet are answered by a local stub server, e.g.
+
+    python3 bench/bench.py --entries 100000 --output results.json --compare previous.json
+"""
+
+import argparse
+import base64
+import concurrent.futures
+import http.server
+import json
+import math
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_PATH)
+
+from settings import settings  # noqa: E402
+
+USERNAME = 'bench'
+PASSWORD = 'bench'
+ROUNDS = ['round-' + str(number) for number in range(20)]
+CHUNK_SIZE = 10_000  # entries added within a single transaction while seeding
+AUTH_HEADERS = {'Authorization': 'Basic ' + base64.b64encode((USERNAME + ':' + PASSWORD).encode()).decode()}
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    """
+    answers like the discord webhooks and the mailjet send API v3.1, every message is accepted
+    """
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if self.path.endswith('/send'):
+            content = json.dumps({'Messages': [{'Status': 'success'} for _ in body.get('Messages', [])]}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+        else:
+            self.send_response(204)
+            self.end_headers()
+
+    def log_message(self, *_args):
+        pass
+
+
+def stub_start():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, name='stub', daemon=True).start()
+    return 'http://127.0.0.1:' + str(server.server_address[1])
+
+
+def config_write(directory, stub_url, cache_entries):
+    config = {
+        'auth': {'username': USERNAME, 'password': PASSWORD},
+        'discord': {'inbox-webhook': stub_url + '/discord', 'batch_window': 0},
+        'mailjet': {'public_key': 'bench', 'private_key': 'bench', 'version': 'v3.1', 'api_url': stub_url},
+        'storage': {'path': directory + '/database.sqlite3'},
+        'cache': {'max_entries': cache_entries},
+        'metrics': {'path': directory + '/metrics.sqlite3'},
+        'ratelimit': {'enabled': False},  # all requests come from the same address
+    }
+    path = directory + '/config.json'
+    with open(path, 'w') as file:
+        json.dump(config, file)
+    return path
+
+
+def seed(storage, resources, entries, revisions, rng):
+    """
+    adds the resources and their entries, every identification has the given number of revisions,
+    returns (resource_uid, identifications) pairs
+    """
+    fixture = []
+    for number in range(resources):
+        resource_uid = storage.generate_uid()
+        storage.resources_add(resource_uid, json.dumps({'name': 'Bench ' + str(number)}), '{}', '', 'bench')
+        count = entries // resources
+        identifications = [storage.generate_uid() for _ in range(max(count // revisions, 1))]
+        rows = []
+        for index in range(count):
+            identification = identifications[index % len(identifications)]
+            rows.append((identification, public_body(rng), private_body(rng, identification),
+                         'https://bench.invalid/', 'bench', None))
+        for start in range(0, len(rows), CHUNK_SIZE):
+            storage.entries_add_many(resource_uid, rows[start:start + CHUNK_SIZE])
+        fixture.append((resource_uid, identifications))
+    return fixture
+
+
+def public_body(rng):
+    return json.dumps({'name': 'Player ' + str(rng.randrange(100_000)), 'rounds': rng.sample(ROUNDS, 3)})
+
+
+def private_body(rng, secret):
+    return json.dumps({'email': 'player' + str(rng.randrange(100_000)) + '@bench.invalid', 'secret': secret})
+
+
+def scenario_entries_add(client, rng, fixture):
+    resource_uid, identifications = rng.choice(fixture)
+    identification = rng.choice(identifications)
+    body = {
+        'identification': identification,
+        'publicBody': json.loads(public_body(rng)),
+        'privateBody': json.loads(private_body(rng, identification)),
+    }
+    return client.post('/resources/' + resource_uid + '/entries', data=json.dumps(body))
+
+
+def scenario_entries_list(client, rng, fixture):
+    resource_uid, _ = rng.choice(fixture)
+    return client.get('/resources/' + resource_uid + '/entries?latest=true&limit=100', headers=AUTH_HEADERS)
+
+
+def scenario_get_registration(client, rng, fixture):
+    resource_uid, identifications = rng.choice(fixture)
+    return client.get('/resources/' + resource_uid + '/registration/' + rng.choice(identifications))
+
+
+def scenario_form(client, rng, fixture):
+    resource_uid, _ = rng.choice(fixture)
+    data = {
+        'public-name': 'Player ' + str(rng.randrange(100_000)),
+        'private-name': 'Player',
+        'private-email': 'player@bench.invalid',
+        'private-message': 'Hello ' * rng.randrange(1, 50),
+        'captcha': '',
+    }
+    return client.post('/form/' + resource_uid + '?redir=false', data=data,
+                       headers={'Referer': 'https://www.gildedernacht.ch/kontakt'})
+
+
+def scenario_resources_list(client, rng, fixture):
+    return client.get('/resources')
+
+
+SCENARIOS = {
+    'entries_add': scenario_entries_add,
+    'entries_list': scenario_entries_list,
+    'get_registration': scenario_get_registration,
+    'form': scenario_form,
+    'resources_list': scenario_resources_list,
+}
+
+
+def percentile(sorted_values, percent):
+    """
+    nearest rank, the values have to be sorted
+    """
+    if not sorted_values:
+        return None
+    return sorted_values[max(math.ceil(percent / 100 * len(sorted_values)) - 1, 0)]
+
+
+def measure(app, scenario, fixture, count, threads, warmup, seed_value):
+    barrier = threading.Barrier(threads + 1)
+
+    def work(worker):
+        client = app.test_client()
+        rng = random.Random(seed_value * 1000 + worker)
+        for _ in range(warmup):
+            scenario(client, rng, fixture)
+        barrier.wait()  # all threads start measuring at once
+        latencies, errors = [], 0
+        for _ in range(count // threads + (1 if worker < count % threads else 0)):
+            started = time.perf_counter()
+            response = scenario(client, rng, fixture)
+            latencies.append(time.perf_counter() - started)
+            if response.status_code >= 400:
+                errors += 1
+        return latencies, errors
+
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        futures = [executor.submit(work, worker) for worker in range(threads)]
+        barrier.wait()
+        started = time.perf_counter()
+        results = [future.result() for future in futures]
+        seconds = time.perf_counter() - started
+
+    latencies = sorted(latency for (worker_latencies, _) in results for latency in worker_latencies)
+    return {
+        'requests': len(latencies),
+        'errors': sum(errors for (_, errors) in results),
+        'seconds': seconds,
+        'throughput': len(latencies) / seconds if seconds > 0 else None,
+        'p50': percentile(latencies, 50),
+        'p99': percentile(latencies, 99),
+        'max': latencies[-1] if latencies else None,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_PATH, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(previous, results):
+    """
+    the change of the throughput and latencies in percent, positive is slower
+    """
+    lines = []
+    for name, current in results.items():
+        before = previous.get('results', {}).get(name)
+        if not before:
+            continue
+        changes = []
+        for key, sign in (('throughput', -1), ('p50', 1), ('p99', 1)):
+            if before.get(key) and current.get(key):
+                changes.append(key + ' ' + format(sign * (current[key] / before[key] - 1) * 100, '+.1f') + '%')
+        lines.append(name + ': ' + ', '.join(changes))
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark of the Olymp API')
+    parser.add_argument('--resources', type=int, default=10)
+    parser.add_argument('--entries', type=int, default=100_000, help='seeded entries across all resources')
+    parser.add_argument('--revisions', type=int, default=5, help='seeded entries per identification')
+    parser.add_argument('--requests', type=int, default=2000, help='measured requests per scenario')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--warmup', type=int, default=10, help='unmeasured requests per thread and scenario')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--no-cache', action='store_true', help='disable the response cache')
+    parser.add_argument('--output', help='file for the results, printed otherwise')
+    parser.add_argument('--compare', help='results of a previous run')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='olymp-bench-')
+    settings.CONFIG_PATH = config_write(directory, stub_start(), 0 if args.no_cache else 256)
+
+    from flask_app import app  # reads the configuration written above
+    from storage import storage
+
+    started = time.perf_counter()
+    fixture = seed(storage, args.resources, args.entries, args.revisions, random.Random(args.seed))
+    seed_seconds = time.perf_counter() - started
+
+    results = {}
+    for name in args.scenarios.split(','):
+        results[name] = measure(app, SCENARIOS[name], fixture, args.requests, args.threads, args.warmup, args.seed)
+        print(name + ': ' + format(results[name]['throughput'], '.0f') + ' requests/s, p50 ' +
+              format(results[name]['p50'] * 1000, '.2f') + ' ms, p99 ' + format(results[name]['p99'] * 1000, '.2f') +
+              ' ms, ' + str(results[name]['errors']) + ' errors', file=sys.stderr)
+
+    report = {
+        'commit': git_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'parameters': vars(args),
+        'directory': directory,  # kept to inspect the database afterwards
+        'seed_seconds': seed_seconds,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.compare:
+        with open(args.compare, 'r') as file:
+            for line in compare(json.load(file), results):
+                print(line, file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+import collections
+import threading
+import time
+
+# can be overwritten by the 'cache' section in config.json, see configure()
+OPTIONS = {
+    'max_entries': 256,
+    'ttl': 60,  # seconds
+    'max_bytes': 32_000_000,  # of all cached values together, a larger value is never cached
+}
+
+_lock = threading.Lock()
+_entries = collections.OrderedDict()  # key: (scope, expires, value, size), least recently used first
+_size = 0  # bytes of all cached values
+_statistics = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+
+def configure(options):
+    OPTIONS['max_entries'] = int(options.get('max_entries', OPTIONS['max_entries']))
+    OPTIONS['ttl'] = float(options.get('ttl', OPTIONS['ttl']))
+    OPTIONS['max_bytes'] = int(options.get('max_bytes', OPTIONS['max_bytes']))
+    clear()
+
+
+def get(key):
+    with _lock:
+        cached = _entries.get(key)
+        if cached is None or cached[1] < time.monotonic():
+            _statistics['misses'] += 1
+            return None
+        _entries.move_to_end(key)
+        _statistics['hits'] += 1
+        return cached[2]
+
+
+def put(key, scope, value, size):
+    """
+    size is the number of bytes of the value, the least recently used values are evicted to stay within max_bytes
+    """
+    global _size
+    if OPTIONS['max_entries'] < 1 or size > OPTIONS['max_bytes']:
+        return
+    with _lock:
+        _remove(key)
+        _entries[key] = (scope, time.monotonic() + OPTIONS['ttl'], value, size)
+        _size += size
+        while len(_entries) > OPTIONS['max_entries'] or _size > OPTIONS['max_bytes']:
+            _remove(next(iter(_entries)))
+
+
+def _remove(key):
+    # the lock has to be held
+    global _size
+    removed = _entries.pop(key, None)
+    if removed is not None:
+        _size -= removed[3]
+
+
+def invalidate(scope):
+    with _lock:
+        for key in [key for key, (entry_scope, _, _, _) in _entries.items() if entry_scope == scope]:
+            _remove(key)
+        _statistics['invalidations'] += 1
+
+
+def clear():
+    global _size
+    with _lock:
+        _entries.clear()
+        _size = 0
+
+
+def statistics():
+    with _lock:
+        return dict(_statistics, size=len(_entries), bytes=_size)
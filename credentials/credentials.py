@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+import base64
+import collections
+import getpass
+import hashlib
+import hmac
+import secrets
+import sys
+import threading
+import time
+
+from settings import settings
+
+# can be overwritten by the 'auth' section in config.json, read on every use
+OPTIONS = {
+    'cache_size': 1024,  # verified credentials kept in memory
+    'cache_ttl': 300,  # seconds
+    'token_ttl': 12 * 60 * 60,  # seconds, tokens are only issued if 'token_secret' is configured
+}
+
+HASH_PREFIX = 'scrypt$'
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+
+_lock = threading.Lock()
+_verified = collections.OrderedDict()  # key: (expires, valid), least recently used first
+_cache_key = secrets.token_bytes(32)  # the cache never holds passwords, only keyed digests of them
+
+
+def password_hash(password, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P):
+    salt = secrets.token_bytes(16)
+    digest = hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p)
+    return HASH_PREFIX + '$'.join([str(n), str(r), str(p), base64.b64encode(salt).decode(),
+                                   base64.b64encode(digest).decode()])
+
+
+def password_verify(password, stored):
+    """
+    stored is either a hash created by password_hash() or a plaintext password, both are compared in constant time
+    """
+    if not stored.startswith(HASH_PREFIX):
+        return hmac.compare_digest(password.encode(), stored.encode())
+    try:
+        n, r, p, salt, digest = stored[len(HASH_PREFIX):].split('$')
+        salt, digest = base64.b64decode(salt), base64.b64decode(digest)
+        computed = hashlib.scrypt(password.encode(), salt=salt, n=int(n), r=int(r), p=int(p), dklen=len(digest))
+    except ValueError:
+        raise ValueError('Invalid Password Hash')
+    return hmac.compare_digest(computed, digest)
+
+
+def users():
+    """
+    the user from 'username' and 'password' and all users from 'users' (username: password or hash)
+    """
+    options = settings.current()['auth']
+    result = dict(options.get('users', {}))
+    result[options['username']] = options['password']
+    return result
+
+
+def _cache_entry(username, password, stored):
+    # the stored value is part of the key, changed passwords are verified again
+    return hmac.new(_cache_key, '\0'.join([username, password, stored or '']).encode(), hashlib.sha256).digest()
+
+
+def cached(username, password):
+    """
+    the cached result of verify(), or None if the credentials have to be verified (and hashed) again
+    """
+    key = _cache_entry(username, password, users().get(username))
+    with _lock:
+        entry = _verified.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            return None
+        _verified.move_to_end(key)
+        return entry[1]
+
+
+def verify(username, password):
+    """
+    checks the credentials against the configuration, the result is cached as hashing is slow on purpose
+    """
+    options = settings.current()['auth']
+    stored = users().get(username)
+    result = cached(username, password)
+    if result is not None:
+        return result
+
+    # an unknown user is compared against the password of 'username', which takes as long as a wrong password
+    valid = password_verify(password, options['password'] if stored is None else stored) and stored is not None
+
+    key = _cache_entry(username, password, stored)
+    now = time.monotonic()
+    cache_size = int(options.get('cache_size', OPTIONS['cache_size']))
+    with _lock:
+        _verified[key] = (now + float(options.get('cache_ttl', OPTIONS['cache_ttl'])), valid)
+        _verified.move_to_end(key)
+        while len(_verified) > cache_size:
+            _verified.popitem(last=False)
+    return valid
+
+
+def token_signature(secret, username, expires, stored):
+    # the stored password is part of the signature, changing it revokes all tokens of the user
+    message = '\0'.join([username, str(expires), stored]).encode()
+    return hmac.new(secret.encode(), message, hashlib.sha256).hexdigest()
+
+
+def token_issue(username):
+    """
+    returns (token, expires) for a verified user, or None if tokens are disabled
+    """
+    options = settings.current()['auth']
+    secret = options.get('token_secret')
+    stored = users().get(username)
+    if not secret or stored is None:
+        return None
+    expires = int(time.time() + float(options.get('token_ttl', OPTIONS['token_ttl'])))
+    encoded = base64.urlsafe_b64encode(username.encode()).decode()
+    return encoded + '.' + str(expires) + '.' + token_signature(secret, username, expires, stored), expires
+
+
+def token_verify(token):
+    """
+    returns the username of a valid token, or None
+    """
+    secret = settings.current()['auth'].get('token_secret')
+    if not secret:
+        return None
+    try:
+        encoded, expires, signature = token.split('.')
+        username = base64.urlsafe_b64decode(encoded.encode()).decode()
+        expires = int(expires)
+    except ValueError:
+        return None
+    stored = users().get(username)
+    if stored is None or expires < time.time():
+        return None
+    if not hmac.compare_digest(signature.encode(), token_signature(secret, username, expires, stored).encode()):
+        return None
+    return username
+
+
+def clear():
+    with _lock:
+        _verified.clear()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'hash':
+        # prints the hash of a password to paste into config.json
+        print(password_hash(getpass.getpass('Password: ')))
+        sys.exit()
+
+    hashed = password_hash('secret')
+    assert hashed.startswith(HASH_PREFIX)
+    assert password_verify('secret', hashed)
+    assert not password_verify('wrong', hashed)
+    assert password_verify('plain', 'plain')
+    assert not password_verify('plain', 'other')
+    try:
+        password_verify('secret', HASH_PREFIX + 'invalid')
+        assert False
+    except ValueError:
+        pass
@@ -1,45 +1,98 @@
 #!/usr/bin/env python3
 
+import csv
 import datetime
-import os
+import hashlib
+import io
+import math
+import threading
+import time
+import zlib
 
 import requests
 import functools
 import collections
 
 from storage import storage
+from cache import cache
+from settings import settings
+from metrics import metrics
+from credentials import credentials
+from ratelimit import ratelimit
+from mail import outbox
 from mail import mailjet
-from mail import discord
-from flask import Flask, request, json, send_from_directory, Response, redirect, make_response
+from flask import Flask, request, json, send_from_directory, Response, redirect, make_response, stream_with_context, g
 from flask_cors import CORS
 
 app = Flask(__name__)
 CORS(app)
 
 
-def load_config():
-    CONFIG_PATH = os.path.dirname(os.path.abspath(__file__))
-    FILE_PATH = CONFIG_PATH + '/config.json'
-    with open(FILE_PATH, 'r') as file:
-        config = json.load(file)
-        return config
+settings.install_signal_handler()
+config = settings.current()  # only used during startup, use settings.current() everywhere else
 
+storage.configure(config.get('storage', {}))
+storage.create()  # creates missing tables and applies pending migrations
 
-config = load_config()
-username = config['auth']['username']
-password = config['auth']['password']
+cache.configure(config.get('cache', {}))
+storage.listeners.append(cache.invalidate)
 
+# can be overwritten by the 'changes' section in config.json, only read on startup
+changes_options = config.get('changes', {})
+MAX_WAIT = int(changes_options.get('max_wait', 30))  # seconds a request for changes may be held open, 0 disables it
+MAX_WAITERS = int(changes_options.get('max_waiters', 4))  # waiting requests per process, further ones answer at once
+_waiters = threading.BoundedSemaphore(max(MAX_WAITERS, 1))
+_written = threading.Condition()
 
-mailClient = mailjet.config(
-    config['mailjet']['public_key'],
-    config['mailjet']['private_key'],
-    config['mailjet']['version']
-)
+
+def notify_written(scope):
+    with _written:
+        _written.notify_all()
+
+
+storage.listeners.append(notify_written)
+
+metrics.configure(config.get('metrics', {}))
+ratelimit.configure(config.get('ratelimit', {}))
+
+
+def record_timing(function, seconds):
+    metrics.observe('storage_query_duration_seconds', {'function': function}, seconds)
+
+
+storage.timings.append(record_timing)
+
+outbox.start()
+
+
+def compact_periodically(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            storage.compact()
+        except Exception:
+            app.logger.exception('moving revisions into the history failed')
+
+
+if storage.DB_OPTIONS['compact_interval'] > 0:
+    threading.Thread(target=compact_periodically, args=(storage.DB_OPTIONS['compact_interval'],), name='compact',
+                     daemon=True).start()
 
 
 def auth_is_valid():
-    return request.authorization and (request.authorization.username == username) and (
-        request.authorization.password == password)
+    header = request.headers.get('Authorization', '')
+    if header.startswith('Bearer '):
+        return credentials.token_verify(header[len('Bearer '):]) is not None
+    if not request.authorization or request.authorization.type != 'basic':
+        return False
+    username, password = request.authorization.username, request.authorization.password
+    verified = credentials.cached(username, password)
+    if verified is not None:
+        return verified
+    # hashing is slow on purpose, random credentials must not keep the workers busy
+    if ratelimit.take_scopes([('auth', request.remote_addr or '')]) is not None:
+        return False
+    return credentials.verify(username, password)
 
 
 def auth_required(fun):
@@ -57,12 +110,52 @@ def auth_required(fun):
     return decorator
 
 
+MAX_BODY_SIZE = 100_000  # bytes of a single entry or form
+
+
+def rate_limited(fun):
+    """
+    decorator rejects requests with a too large body or beyond the rate limits of the client and resource,
+    before the body is read
+    """
+
+    @functools.wraps(fun)
+    def decorator(resource_uid, *args, **kwargs):
+        if request.content_length is not None and request.content_length > MAX_BODY_SIZE:
+            return '', requests.codes.REQUEST_ENTITY_TOO_LARGE
+        retry_after = ratelimit.take(request.remote_addr or '', resource_uid)
+        if retry_after is not None:
+            return '', requests.codes.TOO_MANY_REQUESTS, {'Retry-After': str(math.ceil(retry_after))}
+        return fun(resource_uid, *args, **kwargs)
+
+    return decorator
+
+
+@app.before_request
+def before_request():
+    g.started = time.perf_counter()
+
+
+@app.after_request
+def record_request(response):
+    # the rule instead of the path, e.g. /resources/<resource_uid>/entries, every resource would be a series otherwise
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.increment('http_requests_total', {'route': route, 'method': request.method, 'status': response.status_code})
+    metrics.observe('http_request_duration_seconds', {'route': route, 'method': request.method},
+                    time.perf_counter() - g.started)
+    if not response.is_streamed:
+        metrics.observe('http_response_size_bytes', {'route': route, 'method': request.method},
+                        response.calculate_content_length() or 0, metrics.SIZE_BUCKETS)
+    return response
+
+
 @app.after_request
 def after_request(response):
     response.headers.add('Access-Control-Allow-Origin', '*')
     response.headers.add('Access-Control-Allow-Headers',
                          'Content-Type,Authorization')
     response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE')
+    response.headers.add('Access-Control-Expose-Headers', 'ETag,X-Next-Cursor,X-Sequence')
     return response
 
 
@@ -71,52 +164,200 @@ def server_status():
     return 'Olymp is Up &#128154;', requests.codes.OK
 
 
+def json_object(pairs):
+    """
+    builds a JSON object from keys and already serialized JSON values, keys are expected in sorted order
+    """
+    return '{' + ', '.join(json.dumps(key) + ': ' + value for key, value in pairs) + '}'
+
+
+# the stored bodies are always written with json.dumps, so they are spliced into the response without parsing them again
+
+def resource_filtered(raw_resource, auth):
+    (resource_uid, timestamp, public_body, private_body, url, user_agent) = raw_resource
+    return json_object([
+        ('privateBody', private_body if auth else '{}'),
+        ('publicBody', public_body),
+        ('resourceUid', json.dumps(resource_uid)),
+        ('timestamp', json.dumps(timestamp)),
+        ('url', json.dumps(url if auth else '')),
+        ('userAgent', json.dumps(user_agent if auth else '')),
+    ])
+
+
+def entry_filtered(raw_entry, auth):
+    (resource_uid, entry_uid, timestamp, identification, public_body, private_body, url, user_agent) = raw_entry
+    return json_object([
+        ('entryUid', json.dumps(entry_uid)),
+        ('identification', json.dumps(identification if auth else '')),
+        ('privateBody', private_body if auth else '{}'),
+        ('publicBody', public_body),
+        ('resourceUid', json.dumps(resource_uid)),
+        ('timestamp', json.dumps(timestamp)),
+        ('url', json.dumps(url if auth else '')),
+        ('userAgent', json.dumps(user_agent if auth else '')),
+    ])
+
+
+def json_array(items):
+    return '[' + ', '.join(items) + ']'
+
+
+def json_array_stream(items):
+    """
+    sends one item after the other, the whole array is never kept in memory
+    """
+    yield '['
+    for index, item in enumerate(items):
+        yield (', ' if index > 0 else '') + item
+    yield ']'
+
+
+def validators(scope, auth, parameters=()):
+    """
+    ETag and Last-Modified of a listing, derived from the change counter of the scope without reading any rows,
+    parameters are the normalised arguments changing the body, unknown arguments never create another ETag
+    """
+    version, timestamp = storage.changes_get(scope)
+    view = 'auth' if auth else 'public'  # both views of the same data must never share a validator
+    etag = hashlib.sha1(
+        (scope + ':' + str(version) + ':' + view + ':' + json.dumps(list(parameters))).encode()).hexdigest()
+    last_modified = None
+    if timestamp is not None:
+        last_modified = datetime.datetime.fromisoformat(timestamp).astimezone(datetime.timezone.utc)
+    return etag, last_modified
+
+
+def not_modified(etag, last_modified):
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since and last_modified is not None:
+        # the header only holds whole seconds, a write within the same second as the last response has to be sent,
+        # so the precise time of the last write is compared instead of the rounded Last-Modified
+        return last_modified <= request.if_modified_since
+    return False
+
+
+def conditional(response, etag, last_modified):
+    response = make_response(response)
+    response.set_etag(etag, weak=True)
+    response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'no-cache'  # clients may keep the response, but have to revalidate it
+    response.vary.add('Authorization')  # the public and the authenticated view share the URL and Last-Modified
+    return response
+
+
 @app.route('/resources', methods=['GET'])
 def resources_list():
     auth = auth_is_valid()
-    all_raw_resources = storage.resources_list()
-    all_resources_filtered = []
-    for (resource_uid, timestamp, public_body, private_body, url, user_agent) in all_raw_resources:
-        resource = {
-            'resourceUid': resource_uid,
-            'timestamp': timestamp,
-            'publicBody': json.loads(public_body),
-            'privateBody': json.loads(private_body) if auth else {},
-            'url': url if auth else '',
-            'userAgent': user_agent if auth else '',
-        }
-        all_resources_filtered.append(resource)
-    return json.dumps(all_resources_filtered), requests.codes.OK
+    etag, last_modified = validators(storage.RESOURCES_SCOPE, auth)
+    if not_modified(etag, last_modified):
+        return conditional(('', requests.codes.NOT_MODIFIED), etag, last_modified)
+    stream = request.args.get('stream') == 'true'
+    if stream:
+        raw_resources = storage.resources_iter()
+        resources = (resource_filtered(raw_resource, auth) for raw_resource in raw_resources)
+        return conditional(Response(stream_with_context(json_array_stream(resources)), requests.codes.OK,
+                                    mimetype='application/json'), etag, last_modified)
+    cached = cache.get(etag)  # the etag covers the version of the data, the view and the parameters
+    if cached is None:
+        all_raw_resources = storage.resources_list()
+        all_resources_filtered = [resource_filtered(raw_resource, auth) for raw_resource in all_raw_resources]
+        cached = json_array(all_resources_filtered).encode()
+        cache.put(etag, storage.RESOURCES_SCOPE, cached, len(cached))
+    return conditional((cached, requests.codes.OK), etag, last_modified)
 
 
 # TODO according to the API description on top, there should be the API version in front of the URL?
-# TODO make version with filtering, or add a parameter to enable/disable it??
-# TODO add parameter to limit maximum number of rows?
 @app.route('/resources/<resource_uid>/entries', methods=['GET'])
 def entries_list(resource_uid):
     auth = auth_is_valid()
-    all_raw_entries = storage.entries_list(resource_uid)
-    all_entries_filtered = []
-    for (
-            resource_uid, entry_uid, timestamp, identification, public_body, private_body, url,
-            user_agent) in all_raw_entries:
-        entry = {
-            'resourceUid': resource_uid,
-            'entryUid': entry_uid,
-            'timestamp': timestamp,
-            'identification': identification if auth else '',
-            'publicBody': json.loads(public_body),
-            'privateBody': json.loads(private_body) if auth else {},
-            'url': url if auth else '',
-            'userAgent': user_agent if auth else '',
-        }
-        all_entries_filtered.append(entry)
-    return json.dumps(all_entries_filtered), requests.codes.OK
+    latest = request.args.get('latest') == 'true'  # only the most recent entry per identification
+    stream = request.args.get('stream') == 'true'  # no X-Next-Cursor, use the entryUid of the last entry instead
+    limit = request.args.get('limit')
+    after = request.args.get('after')  # X-Next-Cursor (or the entryUid of the last entry) of the previous page
+    order = request.args.get('order', 'asc')
+    if limit is not None:
+        if not limit.isdigit() or int(limit) < 1:
+            return '', requests.codes.BAD_REQUEST
+        limit = int(limit)
+    if order not in storage.ORDERS:
+        return '', requests.codes.BAD_REQUEST
+    etag, last_modified = validators(resource_uid, auth, (latest, limit, after, order))
+    if not_modified(etag, last_modified):
+        return conditional(('', requests.codes.NOT_MODIFIED), etag, last_modified)
+    if stream:
+        try:
+            if latest:
+                raw_entries = storage.entries_iter_latest(resource_uid, limit, after, order)
+            else:
+                raw_entries = storage.entries_iter(resource_uid, limit, after, order)
+        except ValueError:
+            return '', requests.codes.BAD_REQUEST
+        entries = (entry_filtered(raw_entry, auth) for raw_entry in raw_entries)
+        return conditional(Response(stream_with_context(json_array_stream(entries)), requests.codes.OK,
+                                    mimetype='application/json'), etag, last_modified)
+    cached = cache.get(etag)
+    if cached is None:
+        try:
+            if latest:
+                all_raw_entries = storage.entries_list_latest(resource_uid, limit, after, order)
+            else:
+                all_raw_entries = storage.entries_list(resource_uid, limit, after, order)
+        except ValueError:
+            return '', requests.codes.BAD_REQUEST
+        all_entries_filtered = [entry_filtered(raw_entry, auth) for raw_entry in all_raw_entries]
+        headers = {}
+        if limit is not None and len(all_raw_entries) == limit:
+            headers['X-Next-Cursor'] = storage.entries_cursor(all_raw_entries[-1])  # pass as 'after' to get the next page
+        cached = (json_array(all_entries_filtered).encode(), headers)
+        cache.put(etag, resource_uid, cached, len(cached[0]))
+    body, headers = cached
+    return conditional((body, requests.codes.OK, headers), etag, last_modified)
+
+
+@app.route('/resources/<resource_uid>/changes', methods=['GET'])
+def entries_changes(resource_uid):
+    """
+    only the entries written after the sequence number 'since', continue with the returned X-Sequence
+    """
+    auth = auth_is_valid()
+    since = request.args.get('since', '0')
+    limit = request.args.get('limit')
+    wait = request.args.get('wait', '0')  # seconds to wait for new entries, if there are none yet
+    if not since.isdigit() or not wait.isdigit():
+        return '', requests.codes.BAD_REQUEST
+    if limit is not None:
+        if not limit.isdigit() or int(limit) < 1:
+            return '', requests.codes.BAD_REQUEST
+        limit = int(limit)
+    since = int(since)
+    wait = min(int(wait), MAX_WAIT)
+    if wait > 0 and not auth:
+        return '', requests.codes.UNAUTHORIZED  # a waiting request holds a worker thread
+    deadline = time.monotonic() + wait
+    try:
+        raw_entries = storage.entries_list_since(resource_uid, since, limit)
+    except ValueError:
+        return '', requests.codes.BAD_REQUEST
+    if not raw_entries and wait > 0 and MAX_WAITERS > 0 and _waiters.acquire(blocking=False):
+        try:
+            while not raw_entries and time.monotonic() < deadline:
+                with _written:
+                    # also wakes up regularly, the entry could have been written by another worker process
+                    _written.wait(min(1.0, deadline - time.monotonic()))
+                raw_entries = storage.entries_list_since(resource_uid, since, limit)
+        finally:
+            _waiters.release()
+    entries = [entry_filtered(raw_entry[:8], auth) for raw_entry in raw_entries]
+    sequence = raw_entries[-1][8] if raw_entries else since
+    return json_array(entries), requests.codes.OK, {'X-Sequence': str(sequence)}
 
 
 @app.route('/resources/<resource_uid>/entries', methods=['POST'])
+@rate_limited
 def entries_add(resource_uid):
-    if len(request.data) > 100_000:
+    if len(request.data) > MAX_BODY_SIZE:
         return '', requests.codes.REQUEST_ENTITY_TOO_LARGE
     body = json.loads(request.data)
     identification = body['identification']
@@ -132,15 +373,264 @@ def entries_add(resource_uid):
     return entry_uid, requests.codes.CREATED
 
 
+BULK_MAX_SIZE = 10_000_000  # bytes of a JSON array or NDJSON stream, all entries are added within one transaction
+BULK_MAX_ITEMS = 10_000  # entries of a single request
+
+
+class BulkTooLarge(Exception):
+    pass
+
+
+def bulk_lines(stream):
+    """
+    the non-empty lines, a line longer than MAX_BODY_SIZE is skipped without keeping it in memory and yielded as None,
+    raises BulkTooLarge once more than BULK_MAX_SIZE bytes were read
+    """
+    size = 0
+    while True:
+        line = stream.readline(MAX_BODY_SIZE + 1)
+        size += len(line)
+        if size > BULK_MAX_SIZE:
+            raise BulkTooLarge()
+        if not line:
+            return
+        if len(line) > MAX_BODY_SIZE and not line.endswith(b'\n'):
+            while line and not line.endswith(b'\n'):
+                line = stream.readline(MAX_BODY_SIZE + 1)
+                size += len(line)
+                if size > BULK_MAX_SIZE:
+                    raise BulkTooLarge()
+            yield None
+        elif line.strip():
+            yield line
+
+
+@app.route('/resources/<resource_uid>/entries/bulk', methods=['POST'])
+@auth_required
+def entries_add_bulk(resource_uid):
+    """
+    adds a JSON array or NDJSON stream of entries within a single transaction, returns a result per item
+    """
+    lines = request.mimetype == 'application/x-ndjson'
+    if request.content_length is not None and request.content_length > BULK_MAX_SIZE:
+        return '', requests.codes.REQUEST_ENTITY_TOO_LARGE
+    if lines:
+        items = bulk_lines(request.stream)
+    else:
+        if request.content_length is None:
+            return '', requests.codes.LENGTH_REQUIRED
+        try:
+            items = json.loads(request.get_data())
+        except ValueError:
+            return '', requests.codes.BAD_REQUEST
+        if not isinstance(items, list):
+            return '', requests.codes.BAD_REQUEST
+    url = request.url
+    user_agent = request.headers.get('User-Agent')
+    entries = []
+    results = []
+    try:
+        for index, item in enumerate(items):
+            if index >= BULK_MAX_ITEMS:
+                return '', requests.codes.REQUEST_ENTITY_TOO_LARGE
+            try:
+                if lines:
+                    if item is None:
+                        raise ValueError('Entry Too Large')
+                    item = json.loads(item)
+                if not isinstance(item, dict):
+                    raise ValueError('Invalid Entry')
+                identification = item.get('identification')
+                if identification is None:
+                    identification = ''
+                elif not isinstance(identification, str):
+                    raise ValueError('Invalid Identification')
+                timestamp = item.get('timestamp')
+                if timestamp is not None:
+                    timestamp = datetime.datetime.fromisoformat(timestamp).isoformat()
+                entries.append((identification, json.dumps(item['publicBody']),
+                                json.dumps(item['privateBody']), url, user_agent, timestamp))
+                results.append({'index': index, 'status': requests.codes.CREATED})
+            except (ValueError, TypeError, KeyError) as error:
+                results.append({'index': index, 'status': requests.codes.BAD_REQUEST, 'error': repr(error)})
+    except BulkTooLarge:
+        return '', requests.codes.REQUEST_ENTITY_TOO_LARGE
+    added = iter(storage.entries_add_many(resource_uid, entries))
+    for result in results:
+        if result['status'] == requests.codes.CREATED:
+            result['entryUid'] = next(added)['uid']
+    return json.dumps(results), requests.codes.OK
+
+
+SEARCH_MAX_LIMIT = 1000
+SEARCH_FIELD_PREFIXES = {
+    'public.': 'public_body',
+    'private.': 'private_body',
+}
+
+
+@app.route('/resources/<resource_uid>/search', methods=['GET'])
+def entries_search(resource_uid):
+    """
+    full text search with q, filters on body fields with e.g. public.name=value (private fields need authentication)
+    """
+    auth = auth_is_valid()
+    query = request.args.get('q', '')
+    limit = request.args.get('limit', '100')
+    if not limit.isdigit() or not (1 <= int(limit) <= SEARCH_MAX_LIMIT):
+        return '', requests.codes.BAD_REQUEST
+    fields = []
+    for name, value in request.args.items(multi=True):
+        for prefix, column in SEARCH_FIELD_PREFIXES.items():
+            if name.startswith(prefix):
+                if column == 'private_body' and not auth:
+                    return '', requests.codes.UNAUTHORIZED
+                fields.append((column, name[len(prefix):], value))
+    columns = storage.SEARCH_COLUMNS_ALL if auth else storage.SEARCH_COLUMNS_PUBLIC
+    try:
+        raw_entries = storage.entries_search(resource_uid, query, columns, fields, int(limit))
+    except ValueError:
+        return '', requests.codes.BAD_REQUEST
+    return json_array([entry_filtered(raw_entry, auth) for raw_entry in raw_entries]), requests.codes.OK
+
+
+@app.route('/resources/<resource_uid>/aggregate', methods=['GET'])
+def entries_aggregate(resource_uid):
+    """
+    counts per value of a body field, e.g. group=public.rounds, or per day with group=day,
+    only the latest entry per identification is counted unless latest=false
+    """
+    auth = auth_is_valid()
+    group = request.args.get('group', 'day')
+    latest = request.args.get('latest') != 'false'
+    if group != 'day':
+        for prefix, column in SEARCH_FIELD_PREFIXES.items():
+            if group.startswith(prefix):
+                if column == 'private_body' and not auth:
+                    return '', requests.codes.UNAUTHORIZED
+                group = (column, group[len(prefix):])
+                break
+        else:
+            return '', requests.codes.BAD_REQUEST
+    try:
+        counts = storage.entries_aggregate(resource_uid, group, latest)
+    except ValueError:
+        return '', requests.codes.BAD_REQUEST
+    return json.dumps([{'value': value, 'count': count} for (value, count) in counts]), requests.codes.OK
+
+
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+EXPORT_COLUMNS = ['resourceUid', 'entryUid', 'timestamp', 'identification', 'url', 'userAgent']
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')  # spreadsheets would evaluate such a cell
+
+
+def export_value(value):
+    value = value if isinstance(value, str) else json.dumps(value)  # nested values stay JSON within their cell
+    return "'" + value if value.startswith(FORMULA_PREFIXES) else value
+
+
+def export_fields(body):
+    fields = json.loads(body)
+    return fields if isinstance(fields, dict) else {}  # any JSON value is accepted as body, only objects have keys
+
+
+def csv_lines(raw_entries, public_keys, private_keys):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS + ['public.' + key for key in public_keys] + ['private.' + key for key in private_keys])
+    for (resource_uid, entry_uid, timestamp, identification, public_body, private_body, url, user_agent) in raw_entries:
+        public = export_fields(public_body)
+        private = export_fields(private_body)
+        writer.writerow([resource_uid, entry_uid, timestamp] + [export_value(value) for value in (identification, url, user_agent)] +
+                        [export_value(public[key]) if key in public else '' for key in public_keys] +
+                        [export_value(private[key]) if key in private else '' for key in private_keys])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def gzip_stream(chunks):
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)  # with a gzip header
+    for chunk in chunks:
+        compressed = compressor.compress(chunk.encode())
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def timestamp_argument(name):
+    value = request.args.get(name)
+    return None if value is None else datetime.datetime.fromisoformat(value).isoformat()
+
+
+@app.route('/resources/<resource_uid>/export', methods=['GET'])
+@auth_required
+def entries_export(resource_uid):
+    """
+    streams all entries as NDJSON or as CSV with a column per body key, optionally gzip compressed
+    """
+    export_format = request.args.get('format', 'ndjson')
+    latest = request.args.get('latest') == 'true'
+    compressed = request.args.get('gzip') == 'true'
+    if export_format not in EXPORT_FORMATS:
+        return '', requests.codes.BAD_REQUEST
+    try:
+        start = timestamp_argument('from')
+        end = timestamp_argument('to')
+    except ValueError:
+        return '', requests.codes.BAD_REQUEST
+    try:
+        if latest:
+            raw_entries = storage.entries_iter_latest(resource_uid, start=start, end=end)
+        else:
+            raw_entries = storage.entries_iter(resource_uid, start=start, end=end)
+    except ValueError:
+        return '', requests.codes.BAD_REQUEST
+    if export_format == 'csv':
+        public_keys, private_keys = storage.entries_body_keys(resource_uid)
+        chunks = csv_lines(raw_entries, public_keys, private_keys)
+    else:
+        chunks = (entry_filtered(raw_entry, True) + '\n' for raw_entry in raw_entries)
+    filename = resource_uid + '.' + export_format
+    mimetype = EXPORT_FORMATS[export_format]
+    if compressed:
+        chunks = gzip_stream(chunks)
+        filename += '.gz'
+        mimetype = 'application/gzip'
+    return Response(stream_with_context(chunks), requests.codes.OK, mimetype=mimetype,
+                    headers={'Content-Disposition': 'attachment; filename="' + filename + '"'})
+
+
 @app.route('/resources/<resource_uid>/entries/<entry_uid>', methods=['GET'])
 @auth_required
 def get_entry(resource_uid, entry_uid):
-    return json.dumps(storage.entries_get(resource_uid, entry_uid))
+    raw_entry = storage.entries_get(resource_uid, entry_uid)
+    if raw_entry is None:
+        return '', requests.codes.NOT_FOUND
+    return entry_filtered(raw_entry, True), requests.codes.OK
+
+
+@app.route('/resources/<resource_uid>/history/<identification>', methods=['GET'])
+@auth_required
+def get_history(resource_uid, identification):
+    """
+    all revisions of an identification, including the ones moved into the history, oldest first
+    """
+    try:
+        raw_entries = storage.entries_history(resource_uid, identification)
+    except ValueError:
+        return '', requests.codes.BAD_REQUEST
+    return json_array([entry_filtered(raw_entry, True) for raw_entry in raw_entries]), requests.codes.OK
 
 
 @app.route('/form/<resource_uid>', methods=['POST'])
+@rate_limited
 def form(resource_uid):
-    if len(request.data) > 100_000:
+    if len(request.data) > MAX_BODY_SIZE:
         return '', requests.codes.REQUEST_ENTITY_TOO_LARGE
     PUBLIC_PREFIX = 'public-'
     PRIVATE_PREFIX = 'private-'
@@ -163,8 +653,8 @@ def form(resource_uid):
             private[key[len(PRIVATE_PREFIX):]] = value
         elif key == IDENDTIFICATION:
             identification = value
-        elif key == LANGUAGE:
-            language = value
+        elif key == LANGUAGE and value in mailjet.i18n:
+            language = value  # the messages are built before the entry is stored, unknown languages keep the default
 
     public_body = json.dumps(public)
     private_body = json.dumps(private)
@@ -176,11 +666,6 @@ def form(resource_uid):
         redirect_url = redirect_url + '?msg=spam'
         return redirect(redirect_url) if redir else make_response(redirect_url)
 
-    entry = storage.entries_add(
-        resource_uid, identification, public_body, private_body, url, user_agent)
-
-    config = load_config()
-
     if ('message' in private) and (len(private['message']) > 0):
         message = private['message']
         msg = f'\'{message}\''
@@ -216,10 +701,14 @@ def form(resource_uid):
         }
         template = 'gilde'
 
-    discord.msg_send(resource_uid, entry, msg, redirect_url,
-                     config['discord']['inbox-webhook'])
-    mailjet.mail_send(mailClient, msg, {
-                      'email': private.get('email'), 'name': private.get('name')}, recipient, template, language)
+    notifications = [
+        outbox.discord_notification(resource_uid, msg, redirect_url),
+        outbox.mailjet_notification(msg, {
+            'email': private.get('email'), 'name': private.get('name')}, recipient, template, language),
+    ]
+    storage.entries_add(
+        resource_uid, identification, public_body, private_body, url, user_agent, notifications)
+    outbox.wake()
 
     redirect_url = redirect_url + '?msg=success'
     return redirect(redirect_url) if redir else make_response(redirect_url)
@@ -228,8 +717,9 @@ def form(resource_uid):
 RST_BASE_URL = "https://anmeldung.rollenspieltage.ch/"
 
 @app.route('/resources/<resource_uid>/register', methods=['POST'])
+@rate_limited
 def register(resource_uid):
-    if len(request.data) > 100_000:
+    if len(request.data) > MAX_BODY_SIZE:
         return '', requests.codes.REQUEST_ENTITY_TOO_LARGE
 
     body = json.loads(request.data)
@@ -241,60 +731,61 @@ def register(resource_uid):
 
     url = request.url
     user_agent = request.headers.get('User-Agent')
-    entry = storage.entries_add(
-        resource_uid, secret, public_body, private_body, url, user_agent)
 
-    public = json.loads(public_body)
-    private = json.loads(private_body)
+    public = body['publicBody']
+    private = body['privateBody']
+    notifications = []
 
     if public.get('sendMailToApplicant', False) is True:
         name = private.get('name')
         email = private.get('email')
         edit_link = RST_BASE_URL + '?secret=' + secret
-        mailjet.mail_send(mailClient, edit_link, {
-                          'email': email, 'name': name}, {
+        notifications.append(outbox.mailjet_notification(edit_link, {
+                             'email': email, 'name': name}, {
             'email': 'mail@rollenspieltage.ch',
             'name': 'Luzerner Rollenspieltage'
-        }, 'rollenspieltage', 'de', 'rollenspieltage2022')
+        }, 'rollenspieltage', 'de', 'rollenspieltage2022'))
     elif public.get('sendMailOnlyToUs', False) is True:
         name = private.get('name')
         email = private.get('email')
         edit_link = RST_BASE_URL + '?secret=' + secret
-        mailjet.mail_send(mailClient, edit_link, {
-                          'email': email, 'name': name}, {
+        notifications.append(outbox.mailjet_notification(edit_link, {
+                             'email': email, 'name': name}, {
             'email': 'mail@rollenspieltage.ch',
             'name': 'Luzerner Rollenspieltage'
-        }, 'rollenspieltage', 'de', 'rollenspieltage2022', True)
+        }, 'rollenspieltage', 'de', 'rollenspieltage2022', True))
 
     if public.get('sendDiscordMsg', False) is True:
         edit_link = 'Editieren (ACHTUNG: Mit diesem Link kann die Anmeldung angepasst werden): ' + RST_BASE_URL + '?secret=' + secret
-        discord.msg_send(resource_uid, entry, edit_link, 'Anmeldung Rollenspieltage 2022 (Initiale Registration)', config['discord']['inbox-webhook'])
+        notifications.append(outbox.discord_notification(resource_uid, edit_link, 'Anmeldung Rollenspieltage 2022 (Initiale Registration)'))
+
+    entry = storage.entries_add(
+        resource_uid, secret, public_body, private_body, url, user_agent, notifications)
+    outbox.wake()
 
     return json.dumps({'entry_uid': entry.get('uid'), 'secret': secret}), requests.codes.CREATED
 
 
 @app.route('/resources/<resource_uid>/registration/<secret>', methods=['GET'])
 def get_registration(resource_uid, secret):
-    entry_list = storage.entries_list(resource_uid)
-    registration_entry = None
-    for (resource_uid, entry_uid, timestamp, identification, public_body, private_body, _url, _user_agent) in entry_list:
-        if (identification == secret):
-            registration_entry = {
-                'resourceUid': resource_uid,
-                'entryUid': entry_uid,
-                'timestamp': timestamp,
-                'secret': identification,
-                'publicBody': json.loads(public_body),
-                'privateBody': json.loads(private_body),
-            }
-
-    if (registration_entry is None):
+    latest_entry = storage.entries_latest(resource_uid, secret)
+    if (latest_entry is None):
         return '', requests.codes.UNAUTHORIZED
-    return json.dumps(registration_entry)
+
+    (resource_uid, entry_uid, timestamp, identification, public_body, private_body, _url, _user_agent) = latest_entry
+    return json_object([
+        ('entryUid', json.dumps(entry_uid)),
+        ('privateBody', private_body),
+        ('publicBody', public_body),
+        ('resourceUid', json.dumps(resource_uid)),
+        ('secret', json.dumps(identification)),
+        ('timestamp', json.dumps(timestamp)),
+    ])
 
 @app.route('/resources/<resource_uid>/registration/<secret>', methods=['POST'])
+@rate_limited
 def update(resource_uid, secret):
-    if len(request.data) > 100_000:
+    if len(request.data) > MAX_BODY_SIZE:
         return '', requests.codes.REQUEST_ENTITY_TOO_LARGE
 
     body = json.loads(request.data)
@@ -305,34 +796,37 @@ def update(resource_uid, secret):
 
     url = request.url
     user_agent = request.headers.get('User-Agent')
-    entry = storage.entries_add(
-        resource_uid, secret, public_body, private_body, url, user_agent)
 
-    public = json.loads(public_body)
-    private = json.loads(private_body)
+    public = body['publicBody']
+    private = body['privateBody']
+    notifications = []
 
     if public.get('sendMailToApplicant', False) is True:
         name = private.get('name')
         email = private.get('email')
         edit_link = RST_BASE_URL + '?secret=' + secret
-        mailjet.mail_send(mailClient, edit_link, {
-                          'email': email, 'name': name}, {
+        notifications.append(outbox.mailjet_notification(edit_link, {
+                             'email': email, 'name': name}, {
             'email': 'mail@rollenspieltage.ch',
             'name': 'Luzerner Rollenspieltage'
-        }, 'rollenspieltage', 'de', 'rollenspieltage2022')
+        }, 'rollenspieltage', 'de', 'rollenspieltage2022'))
     elif public.get('sendMailOnlyToUs', False) is True:
         name = private.get('name')
         email = private.get('email')
         edit_link = RST_BASE_URL + '?secret=' + secret
-        mailjet.mail_send(mailClient, edit_link, {
-                          'email': email, 'name': name}, {
+        notifications.append(outbox.mailjet_notification(edit_link, {
+                             'email': email, 'name': name}, {
             'email': 'mail@rollenspieltage.ch',
             'name': 'Luzerner Rollenspieltage'
-        }, 'rollenspieltage', 'de', 'rollenspieltage2022', True)
+        }, 'rollenspieltage', 'de', 'rollenspieltage2022', True))
 
     if public.get('sendDiscordMsg', False) is True:
         edit_link = 'Editieren (ACHTUNG: Mit diesem Link kann die Anmeldung angepasst werden): ' + RST_BASE_URL + '?secret=' + secret
-        discord.msg_send(resource_uid, entry, edit_link, 'Anmeldung Rollenspieltage 2022 (Update)', config['discord']['inbox-webhook'])
+        notifications.append(outbox.discord_notification(resource_uid, edit_link, 'Anmeldung Rollenspieltage 2022 (Update)'))
+
+    entry = storage.entries_add(
+        resource_uid, secret, public_body, private_body, url, user_agent, notifications)
+    outbox.wake()
 
     return json.dumps({'entry_uid': entry.get('uid'), 'secret': secret}), requests.codes.CREATED
 
@@ -370,10 +864,30 @@ def js():
     return send_from_directory('static', 'olymp.js')
 
 
+@app.route('/token', methods=['POST'])
+@auth_required
+def token_issue():
+    """
+    a token to send as 'Authorization: Bearer <token>' instead of the password, only if 'token_secret' is configured
+    """
+    issued = credentials.token_issue(request.authorization.username)
+    if issued is None:
+        return '', requests.codes.NOT_FOUND
+    (token, expires) = issued
+    return json.dumps({'token': token, 'expires': expires}), requests.codes.CREATED
+
+
+@app.route('/metrics')
+@auth_required
+def metrics_export():
+    return Response(metrics.render(), requests.codes.OK, mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/status')
 def status():
     status = {
         'version': '1.0.1',
         'time': datetime.datetime.now().isoformat(),
+        'cache': cache.statistics(),
     }
     return json.dumps(status), requests.codes.OK
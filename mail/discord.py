@@ -1,19 +1,43 @@
 #!/usr/bin/env python3
 
-import requests
+from metrics import metrics
+from mail import transport
 
-def msg_send(resource_uid, entry, msg, redirect_url, webhook):
+MAX_LENGTH = 2000  # characters of a single discord message
+SEPARATOR = '\n\n---\n\n'  # between the notifications combined into one message
+
+
+def msg_content(resource_uid, entry, msg, redirect_url):
     entry_url = 'https://api.gildedernacht.ch/resources/' + \
         resource_uid + '/entries/' + entry['uid']
 
     words = msg.split(' ')
     msg_excerpt = words if len(words) < 20 else words[0:10] + ['[...]'] + words[-10:]
 
-    payload = {'content': 'Neue Nachricht von \'' + redirect_url + '\':'\
+    content = 'Neue Nachricht von \'' + redirect_url + '\':'\
         '\n\n' \
         'Nachrichtauszug:\n' \
         '_' + (' '.join(msg_excerpt)) + '_' \
         '\n\n' + entry_url
-    }
+    if len(content) > MAX_LENGTH:
+        content = content[:MAX_LENGTH - len(entry_url) - 6] + '[...]\n' + entry_url  # always keep the link
+    return content
+
+
+def msg_send(resource_uid, entry, msg, redirect_url, webhook):
+    return content_send(msg_content(resource_uid, entry, msg, redirect_url), webhook)
+
+
+@metrics.outbound('discord')
+def content_send(content, webhook):
+    return transport.session().post(webhook, json={'content': content}, timeout=transport.TIMEOUT)
+
 
-    requests.post(webhook, json=payload)
+def retry_after(response):
+    """
+    seconds to wait after a response with status 429, from the header or the body discord sends along
+    """
+    try:
+        return float(response.headers.get('Retry-After') or response.json()['retry_after'])
+    except (ValueError, KeyError, TypeError):
+        return 60
@@ -1,8 +1,17 @@
 #!/usr/bin/env python3
 
+import functools
+
 # import the mailjet wrapper
 from mailjet_rest import Client
 
+from settings import settings
+from metrics import metrics
+from mail import transport
+
+MAX_MESSAGES = 50  # per call of the send API v3.1
+API_URL = 'https://api.mailjet.com/'  # can be overwritten by 'api_url' in the 'mailjet' section, e.g. for a local stub
+
 mail_template = {
     'gilde': 2939493,
     'spieltage': 2939553,
@@ -59,64 +68,116 @@ i18n = {
 }
 
 
-def config(public_key, private_key, version):
-    return Client(auth=(public_key, private_key), version=version)
+_client = None  # (credentials, client)
 
 
-def mail_send(client, message, sender, recipient, template, language='de', kind='default', sendOnlyToUs=False):
+def config(public_key, private_key, version, api_url=API_URL):
+    # the client is cached by client() and keeps its own connection pool
+    return Client(auth=(public_key, private_key), version=version, api_url=api_url)
+
+
+def client():
+    """
+    returns a client for the current configuration, a new one is only created if the credentials were changed
+    """
+    global _client
+    options = settings.current()['mailjet']
+    credentials = (options['public_key'], options['private_key'], options['version'], options.get('api_url', API_URL))
+    if _client is None or _client[0] != credentials:
+        _client = (credentials, config(*credentials))
+    return _client[1]
+
+
+@functools.lru_cache(maxsize=None)
+def skeletons(template, language, kind):
+    """
+    the parts of both messages which only depend on template, language and kind, never modify the returned dicts
+    """
     texts = i18n[language][kind]
-    senderMail = sender.get('email')
-    senderName = sender.get('name')
 
     copyToSender = {
-        'To': [
-            {
-                'Email': senderMail,
-                'Name': senderName
-            }
-        ],
         'TemplateID': mail_template.get(template),
         'TemplateLanguage': True,
         'Subject': texts['weReceivedYourMsg'],
         'Variables': {
             'title': texts['thankYouForYourMsg'],
             'msgBeforeQuote': texts['yourMsg'] + ':',
-            'quote': message,
             'msgAfterQuote': texts['weTryContactYou']
         }
     }
 
     messageToRecipient = {
-        'To': [
-            {
-                'Email': recipient['email'],
-                'Name': recipient['name']
-            }
-        ],
         'TemplateID': mail_template.get(template),
         'TemplateLanguage': True,
         'Subject': texts['weReceivedAMsg'],
         'Variables': {
             'title': texts['newMsg'],
             'msgBeforeQuote': texts['theMsg'] + ':',
-            'quote': message,
-            'msgAfterQuote': texts['from'] + ' ' + (senderName if isinstance(senderName, str) else '-name missing-') + ', ' + (senderMail if isinstance(senderMail, str) else '-email missing-')
         }
     }
 
+    return copyToSender, messageToRecipient, texts['from']
+
+
+def messages(message, sender, recipient, template, language='de', kind='default', sendOnlyToUs=False):
+    copyToSenderSkeleton, messageToRecipientSkeleton, fromText = skeletons(template, language, kind)
+    senderMail = sender.get('email')
+    senderName = sender.get('name')
+
+    copyToSender = dict(copyToSenderSkeleton)
+    copyToSender['To'] = [
+        {
+            'Email': senderMail,
+            'Name': senderName
+        }
+    ]
+    copyToSender['Variables'] = dict(copyToSenderSkeleton['Variables'], quote=message)
+
+    messageToRecipient = dict(messageToRecipientSkeleton)
+    messageToRecipient['To'] = [
+        {
+            'Email': recipient['email'],
+            'Name': recipient['name']
+        }
+    ]
+    messageToRecipient['Variables'] = dict(
+        messageToRecipientSkeleton['Variables'], quote=message,
+        msgAfterQuote=fromText + ' ' + (senderName if isinstance(senderName, str) else '-name missing-') + ', ' + (senderMail if isinstance(senderMail, str) else '-email missing-'))
+
     if (senderMail is not None and senderName is not None):
         messageToRecipient['ReplyTo'] = {
             'Email': senderMail,
             'Name': senderName
         }
 
-    data = {
-        'Messages': [
-            messageToRecipient
-        ]
-    }
+    result = [messageToRecipient]
 
     if (senderMail is not None and senderName is not None and not sendOnlyToUs):
-        data['Messages'].append(copyToSender)
+        result.append(copyToSender)
+
+    return result
+
+
+def mail_send(client, message, sender, recipient, template, language='de', kind='default', sendOnlyToUs=False):
+    return messages_send(client, messages(message, sender, recipient, template, language, kind, sendOnlyToUs))
+
+
+@metrics.outbound('mailjet')
+def messages_send(client, messages):
+    """
+    the send API accepts up to MAX_MESSAGES messages in a single call
+    """
+    return client.send.create(data={'Messages': messages}, timeout=transport.TIMEOUT)
+
 
-    client.send.create(data=data)
+def messages_results(response, count):
+    """
+    returns for every sent message if it was accepted, in the same order as the messages were sent
+    """
+    try:
+        results = response.json().get('Messages', [])
+    except ValueError:
+        results = []
+    if len(results) != count:
+        raise RuntimeError('Mailjet responded with ' + str(response.status_code) + ': ' + response.text)
+    return [result.get('Status') == 'success' for result in results]
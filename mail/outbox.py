@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+
+import collections
+import functools
+import json
+import datetime
+import logging
+import os
+import tempfile
+import threading
+
+from storage import storage
+from settings import settings
+from mail import discord
+from mail import mailjet
+
+MAX_ATTEMPTS = 8
+BACKOFF_BASE = 30  # seconds, doubled after every failed attempt
+BACKOFF_MAX = 6 * 60 * 60  # seconds
+LEASE = 5 * 60  # seconds, a claimed notification is retried after this time if the dispatcher dies while sending
+POLL_INTERVAL = 60  # seconds
+BATCH_SIZE = 50
+
+# can be overwritten by the 'discord' section in config.json
+DISCORD_BATCH_WINDOW = 30  # seconds a discord notification waits for more of the same resource, 0 sends at once
+DISCORD_BATCH_MAX_ITEMS = 10  # notifications combined into one discord message at most
+
+logger = logging.getLogger(__name__)
+
+_wake = threading.Event()
+_thread = None
+
+
+def discord_notification(resource_uid, msg, redirect_url):
+    return 'discord', json.dumps({'resource_uid': resource_uid, 'msg': msg, 'redirect_url': redirect_url})
+
+
+def mailjet_notification(message, sender, recipient, template, language='de', kind='default', sendOnlyToUs=False):
+    return 'mailjet', json.dumps({
+        'messages': mailjet.messages(message, sender, recipient, template, language, kind, sendOnlyToUs),
+    })
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after):
+        super().__init__('rate limited, retry after ' + str(retry_after) + ' seconds')
+        self.retry_after = retry_after
+
+
+def in_seconds(seconds):
+    return (datetime.datetime.now() + datetime.timedelta(seconds=seconds)).isoformat()
+
+
+def mailjet_messages(payload):
+    arguments = json.loads(payload)
+    if 'messages' in arguments:
+        return arguments['messages']
+    return mailjet.messages(**arguments)  # stored before the messages were built on submission
+
+
+def discord_content(entry_uid, payload):
+    arguments = json.loads(payload)
+    return discord.msg_content(arguments['resource_uid'], {'uid': entry_uid}, arguments['msg'],
+                               arguments['redirect_url'])
+
+
+def deliver_discord(contents, webhook):
+    response = discord.content_send(discord.SEPARATOR.join(contents), webhook)
+    if response.status_code == 429:
+        raise RateLimited(discord.retry_after(response))
+    response.raise_for_status()
+
+
+def discord_batches(rows, max_items):
+    """
+    splits the rows into batches, every batch fits into a single discord message
+    """
+    batch, length = [], 0
+    for row in rows:
+        content = discord_content(row[3], row[4])
+        added = len(content) + (len(discord.SEPARATOR) if batch else 0)
+        if batch and (len(batch) >= max_items or length + added > discord.MAX_LENGTH):
+            yield batch
+            batch, length = [], 0
+            added = len(content)
+        batch.append((row, content))
+        length += added
+    if batch:
+        yield batch
+
+
+def claim(rows):
+    return [row for row in rows if storage.outbox_claim(row[0], row[6], in_seconds(LEASE))]
+
+
+def retry(row, error, payload=None):
+    (outbox_id, kind, _resource_uid, _entry_uid, _payload, attempts, _next_attempt) = row
+    attempts = attempts + 1
+    if isinstance(error, RateLimited):
+        delay = error.retry_after
+    else:
+        delay = min(BACKOFF_BASE * (2 ** (attempts - 1)), BACKOFF_MAX)
+    storage.outbox_retry(outbox_id, attempts, in_seconds(delay), repr(error), payload)
+    logger.warning('sending %s notification %d failed (attempt %d): %r', kind, outbox_id, attempts, error)
+
+
+def settle(rows, send):
+    """
+    sends claimed rows at once, removes them from the outbox or schedules their next attempt,
+    returns the number of notifications sent successfully
+    """
+    try:
+        send()
+    except Exception as error:
+        for row in rows:
+            retry(row, error)
+        return 0
+    for row in rows:
+        storage.outbox_done(row[0])
+    return len(rows)
+
+
+def mailjet_batches(rows):
+    """
+    splits the rows into batches, every batch is sent with a single call of the send API
+    """
+    batch, count = [], 0
+    for row in rows:
+        messages = mailjet_messages(row[4])
+        if batch and count + len(messages) > mailjet.MAX_MESSAGES:
+            yield batch
+            batch, count = [], 0
+        batch.append((row, messages))
+        count += len(messages)
+    if batch:
+        yield batch
+
+
+def settle_mailjet(batch, mail_client):
+    """
+    like settle(), but mailjet reports a result per message, only the failed messages of a notification are retried
+    """
+    all_messages = [message for (_, messages) in batch for message in messages]
+    try:
+        response = mailjet.messages_send(mail_client, all_messages)
+        results = mailjet.messages_results(response, len(all_messages))
+    except Exception as error:
+        for (row, _) in batch:
+            retry(row, error)
+        return 0
+    sent = 0
+    for (row, messages) in batch:
+        own_results, results = results[:len(messages)], results[len(messages):]
+        failed = [message for (message, accepted) in zip(messages, own_results) if not accepted]
+        if failed:
+            retry(row, RuntimeError(str(len(failed)) + ' of ' + str(len(messages)) + ' messages were rejected'),
+                  json.dumps({'messages': failed}))
+        else:
+            storage.outbox_done(row[0])
+            sent += 1
+    return sent
+
+
+def dispatch_due(mail_client, webhook, batch_window=DISCORD_BATCH_WINDOW, batch_max_items=DISCORD_BATCH_MAX_ITEMS):
+    """
+    sends all notifications which are due, returns the number of notifications sent successfully
+    """
+    sent = 0
+    discord_rows = collections.OrderedDict()  # resource_uid: rows, combined into as few messages as possible
+    mailjet_rows = []
+    for row in storage.outbox_due(storage.generate_timestamp(), MAX_ATTEMPTS, BATCH_SIZE):
+        (outbox_id, kind, resource_uid, entry_uid, payload, attempts, next_attempt) = row
+        if kind == 'discord':
+            discord_rows.setdefault(resource_uid, []).append(row)
+        elif kind == 'mailjet':
+            mailjet_rows.append(row)
+        else:
+            sent += settle(claim([row]), functools.partial(invalid_kind, kind))
+
+    for batch in mailjet_batches(claim(mailjet_rows)):  # rows claimed by another worker process are skipped
+        sent += settle_mailjet(batch, mail_client)
+
+    waited_long_enough = in_seconds(-batch_window)
+    for resource_uid, rows in discord_rows.items():
+        ready = any(attempts > 0 or next_attempt <= waited_long_enough
+                    for (_, _, _, _, _, attempts, next_attempt) in rows)
+        if not ready and len(rows) < batch_max_items:
+            continue  # wait for more notifications of this resource
+        for batch in discord_batches(claim(rows), batch_max_items):
+            sent += settle([row for (row, _) in batch],
+                           functools.partial(deliver_discord, [content for (_, content) in batch], webhook))
+    return sent
+
+
+def invalid_kind(kind):
+    raise ValueError('Invalid Notification Kind: ' + kind)
+
+
+def run():
+    while True:
+        interval = POLL_INTERVAL
+        try:
+            # the configuration is looked up every time, changed credentials are used without a restart
+            options = settings.current()['discord']
+            batch_window = float(options.get('batch_window', DISCORD_BATCH_WINDOW))
+            batch_max_items = int(options.get('batch_max_items', DISCORD_BATCH_MAX_ITEMS))
+            interval = min(POLL_INTERVAL, max(batch_window, 1))  # notifications held back become ready in time
+            while dispatch_due(mailjet.client(), options['inbox-webhook'], batch_window, batch_max_items) == BATCH_SIZE:
+                pass
+        except Exception:
+            logger.exception('dispatching notifications failed')
+        _wake.wait(interval)
+        _wake.clear()
+
+
+def start():
+    """
+    starts the background dispatcher of this process, requests only store their notifications and call wake()
+    """
+    global _thread
+    if _thread is None or not _thread.is_alive():
+        _thread = threading.Thread(target=run, name='outbox', daemon=True)
+        _thread.start()
+
+
+def wake():
+    _wake.set()
+
+
+if __name__ == '__main__':
+    class Response:
+        status_code = 200
+        text = ''
+
+        def __init__(self, statuses):
+            self.statuses = statuses
+
+        def json(self):
+            return {'Messages': [{'Status': status} for status in self.statuses]}
+
+    class Send:
+        def __init__(self, statuses):
+            self.statuses = statuses
+            self.sent = []
+
+        def create(self, data, timeout):
+            self.sent.append(data['Messages'])
+            return Response(self.statuses[:len(data['Messages'])])
+
+    class MailClient:
+        def __init__(self, statuses):
+            self.send = Send(statuses)
+
+    storage.configure({'path': os.path.join(tempfile.mkdtemp(), 'database.sqlite3')})
+    storage.create()
+    resource_uid = storage.generate_uid()
+    storage.resources_add(resource_uid, '{}', '{}', '', '')
+    sender = {'email': 'sender@example.com', 'name': 'Sender'}
+    recipient = {'email': 'recipient@example.com', 'name': 'Recipient'}
+    storage.entries_add(resource_uid, '', '{}', '{}', '', '', [
+        mailjet_notification('first', sender, recipient, 'gilde'),
+        mailjet_notification('second', sender, recipient, 'gilde', 'en'),
+    ])
+
+    # the messages of both notifications are sent at once, only the rejected one of the second is kept
+    client = MailClient(['success', 'success', 'success', 'error'])
+    assert dispatch_due(client, None) == 1
+    assert [len(messages) for messages in client.send.sent] == [4]
+    (row,) = storage.outbox_due(in_seconds(BACKOFF_BASE + 1), MAX_ATTEMPTS, BATCH_SIZE)
+    assert row[5] == 1
+    (retried,) = mailjet_messages(row[4])
+    assert retried == client.send.sent[0][3]
+    assert retried['To'] == [{'Email': 'sender@example.com', 'Name': 'Sender'}]
+
+    # a response without a result per message retries every notification of the batch unchanged
+    client = MailClient([])
+    assert settle_mailjet([(row, mailjet_messages(row[4]))], client) == 0
+    (row,) = storage.outbox_due(in_seconds(BACKOFF_MAX + 1), MAX_ATTEMPTS, BATCH_SIZE)
+    assert row[5] == 2
+    assert mailjet_messages(row[4]) == [retried]
+
+    # retried messages are sent again and removed once accepted
+    client = MailClient(['success'])
+    storage.outbox_retry(row[0], row[5], storage.generate_timestamp(), 'due again')
+    assert dispatch_due(client, None) == 1
+    assert client.send.sent == [[retried]]
+    assert storage.outbox_due(in_seconds(BACKOFF_MAX + 1), MAX_ATTEMPTS, BATCH_SIZE) == []
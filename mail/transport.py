@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+TIMEOUT = (3.05, 10)  # seconds to connect, seconds to wait for the response
+POOL_SIZE = 10
+
+# only retried if the request was certainly not processed, repeating it must never send a message twice
+RETRIES = Retry(
+    total=3,
+    connect=3,
+    read=0,
+    status=2,
+    status_forcelist=(429, 503),
+    allowed_methods=None,  # POST as well
+    backoff_factor=0.5,
+    respect_retry_after_header=True,
+    raise_on_status=False,
+)
+
+_lock = threading.Lock()
+_session = None  # (pid, session)
+
+
+def session():
+    """
+    returns the session shared by all outgoing requests of this process, it keeps the connections alive
+    """
+    global _session
+    with _lock:
+        if _session is None or _session[0] != os.getpid():  # never share the connections of the parent after a fork
+            adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=RETRIES)
+            new_session = requests.Session()
+            new_session.mount('https://', adapter)
+            new_session.mount('http://', adapter)
+            _session = (os.getpid(), new_session)
+        return _session[1]
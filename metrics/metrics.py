@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+import atexit
+import collections
+import functools
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+METRICS_PATH = os.path.dirname(os.path.abspath(__file__)) + '/metrics.sqlite3'
+
+# can be overwritten by the 'metrics' section in config.json, see configure()
+OPTIONS = {
+    'path': METRICS_PATH,  # shared by all processes (WSGI workers), every process adds its samples to the stored ones
+    'flush_interval': 5,  # seconds samples are collected in memory before they are added to the stored ones
+}
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # seconds
+SIZE_BUCKETS = (100, 1000, 10_000, 100_000, 1_000_000, 10_000_000)  # bytes
+
+# name: (type, help), the samples of a histogram are stored as name_bucket, name_sum and name_count
+METRICS = {
+    'http_requests_total': ('counter', 'Handled requests by route, method and status.'),
+    'http_request_duration_seconds': ('histogram', 'Time until a response was returned, a streamed body is not included.'),
+    'http_response_size_bytes': ('histogram', 'Size of the responses which were not streamed.'),
+    'storage_query_duration_seconds': ('histogram', 'Time spent within a storage function.'),
+    'outbound_requests_total': ('counter', 'Requests to discord and mailjet by status, error if no response was received.'),
+    'outbound_request_duration_seconds': ('histogram', 'Time until discord or mailjet responded.'),
+}
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_pending = collections.defaultdict(float)  # (sample name, labels): value not yet added to the stored one
+_flushed = time.monotonic()
+
+
+def configure(options):
+    OPTIONS['path'] = options.get('path', OPTIONS['path'])
+    OPTIONS['flush_interval'] = float(options.get('flush_interval', OPTIONS['flush_interval']))
+
+
+def labels_text(labels):
+    escaped = {key: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for key, value in labels.items()}
+    return ','.join(key + '="' + escaped[key] + '"' for key in sorted(escaped))
+
+
+def increment(name, labels, value=1):
+    with _lock:
+        _pending[(name, labels_text(labels))] += value
+    flush_due()
+
+
+def observe(name, labels, value, buckets=LATENCY_BUCKETS):
+    """
+    adds the value to a histogram, every bucket counts the values less than or equal to its bound
+    """
+    text = labels_text(labels)
+    prefix = text + ',' if text else ''
+    with _lock:
+        for bound in buckets:
+            _pending[(name + '_bucket', prefix + 'le="' + str(bound) + '"')] += 1 if value <= bound else 0
+        _pending[(name + '_bucket', prefix + 'le="+Inf"')] += 1
+        _pending[(name + '_sum', text)] += value
+        _pending[(name + '_count', text)] += 1
+    flush_due()
+
+
+def outbound(service):
+    """
+    decorator measures a function sending a request to another service, it has to return the response
+    """
+
+    def decorator(fun):
+        @functools.wraps(fun)
+        def measured(*args, **kwargs):
+            started = time.perf_counter()
+            status = 'error'
+            try:
+                response = fun(*args, **kwargs)
+                status = str(response.status_code)
+                return response
+            finally:
+                observe('outbound_request_duration_seconds', {'service': service}, time.perf_counter() - started)
+                increment('outbound_requests_total', {'service': service, 'status': status})
+
+        return measured
+
+    return decorator
+
+
+def connect():
+    conn = sqlite3.connect(OPTIONS['path'], isolation_level=None, timeout=5)
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS metrics (
+            name TEXT NOT NULL,
+            labels TEXT NOT NULL,
+            value REAL NOT NULL,
+            PRIMARY KEY (name, labels)
+        )
+    ''')
+    return conn
+
+
+def flush():
+    """
+    adds the samples collected by this process to the stored ones, they are kept for the next flush on failure
+    """
+    global _flushed
+    with _lock:
+        samples = list(_pending.items())
+        _pending.clear()
+        _flushed = time.monotonic()
+    if not samples:
+        return
+
+    upsert_sql = '''
+        INSERT INTO metrics (name, labels, value) VALUES (?, ?, ?)
+            ON CONFLICT (name, labels) DO UPDATE SET value = value + excluded.value
+    '''
+    try:
+        conn = connect()
+        try:
+            with conn:
+                conn.execute('BEGIN IMMEDIATE')
+                conn.executemany(upsert_sql, [(name, labels, value) for ((name, labels), value) in samples])
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        logger.exception('storing the metrics failed')
+        with _lock:
+            for key, value in samples:
+                _pending[key] += value
+
+
+def flush_due():
+    if time.monotonic() - _flushed >= OPTIONS['flush_interval']:
+        flush()
+
+
+def _sample_order(row):
+    name, labels, _ = row
+    rest, _, bound = labels.rpartition('le="')
+    if not name.endswith('_bucket') or not bound:
+        return name, labels, 0
+    return name, rest, float(bound.rstrip('"'))  # float('+Inf') is infinite
+
+
+def render():
+    """
+    the samples of all processes in the Prometheus text format
+    """
+    flush()
+    conn = connect()
+    try:
+        rows = conn.execute('SELECT name, labels, value FROM metrics').fetchall()
+    finally:
+        conn.close()
+
+    samples = collections.defaultdict(list)
+    for row in sorted(rows, key=_sample_order):
+        name = row[0]
+        if name not in METRICS:
+            name = name.rpartition('_')[0]
+        samples[name].append(row)
+
+    lines = []
+    for name in sorted(samples):
+        if name not in METRICS:
+            continue
+        kind, description = METRICS[name]
+        lines.append('# HELP ' + name + ' ' + description)
+        lines.append('# TYPE ' + name + ' ' + kind)
+        for (sample, labels, value) in samples[name]:
+            lines.append(sample + ('{' + labels + '}' if labels else '') + ' ' + repr(value))
+    return '\n'.join(lines) + '\n'
+
+
+atexit.register(flush)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+import os
+import sqlite3
+import threading
+import time
+
+RATELIMIT_PATH = os.path.dirname(os.path.abspath(__file__)) + '/ratelimit.sqlite3'
+
+# can be overwritten by the 'ratelimit' section in config.json, see configure()
+OPTIONS = {
+    'enabled': True,
+    'path': RATELIMIT_PATH,  # shared by all processes (WSGI workers), None keeps the buckets within the process
+    'ip': {'rate': 0.5, 'burst': 30},  # tokens per second, tokens at most, per client address
+    'resource': {'rate': 20, 'burst': 200},  # per resource, across all clients
+    'auth': {'rate': 0.1, 'burst': 10},  # credentials per client which are not cached yet and have to be hashed
+}
+
+SCOPES = ('ip', 'resource', 'auth')
+
+PRUNE_INTERVAL = 60  # seconds between removing the buckets which are full again, a missing bucket is full
+
+_local = threading.local()
+_lock = threading.Lock()
+_buckets = {}  # key: (tokens, updated), if the buckets are kept within the process
+_pruned = 0
+
+
+def configure(options):
+    OPTIONS['enabled'] = bool(options.get('enabled', OPTIONS['enabled']))
+    OPTIONS['path'] = options.get('path', OPTIONS['path'])
+    for scope in SCOPES:
+        limit = dict(OPTIONS[scope], **options.get(scope, {}))
+        if float(limit['rate']) <= 0 or float(limit['burst']) < 1:
+            raise ValueError('Invalid Rate Limit')
+        OPTIONS[scope] = {'rate': float(limit['rate']), 'burst': float(limit['burst'])}
+    with _lock:
+        _buckets.clear()
+
+
+def connection():
+    """
+    returns a connection which is kept open and reused by the current thread (and process)
+    """
+    key = (os.getpid(), OPTIONS['path'])
+    cached = getattr(_local, 'connection', None)
+    if cached is None or cached[0] != key:
+        conn = sqlite3.connect(OPTIONS['path'], isolation_level=None, timeout=5)
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = OFF')  # losing the buckets on a crash only resets the limits
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS buckets (
+                key TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated REAL NOT NULL
+            )
+        ''')
+        _local.connection = (key, conn)
+        cached = _local.connection
+    return cached[1]
+
+
+def take_shared(key, rate, burst, now):
+    # refills the bucket and takes a token in one statement, nothing is returned if the bucket is empty
+    take_sql = '''
+        INSERT INTO buckets (key, tokens, updated) VALUES (?1, ?3 - 1, ?4)
+            ON CONFLICT (key) DO UPDATE SET tokens = MIN(?3, tokens + (?4 - updated) * ?2) - 1, updated = ?4
+            WHERE MIN(?3, tokens + (?4 - updated) * ?2) >= 1
+        RETURNING tokens
+    '''
+    conn = connection()
+    if conn.execute(take_sql, [key, rate, burst, now]).fetchone() is not None:
+        return None
+    row = conn.execute('SELECT tokens, updated FROM buckets WHERE key = ?', [key]).fetchone()
+    tokens = min(burst, row[0] + (now - row[1]) * rate) if row else burst
+    return (1 - tokens) / rate
+
+
+def take_local(key, rate, burst, now):
+    with _lock:
+        tokens, updated = _buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        if tokens < 1:
+            return (1 - tokens) / rate
+        _buckets[key] = (tokens - 1, now)
+        return None
+
+
+def prune(now):
+    """
+    removes the buckets which are full again
+    """
+    global _pruned
+    if now - _pruned < PRUNE_INTERVAL:
+        return
+    _pruned = now
+    slowest = min((OPTIONS[scope] for scope in SCOPES), key=lambda limit: limit['rate'] / limit['burst'])
+    full_before = now - slowest['burst'] / slowest['rate']
+    if OPTIONS['path'] is None:
+        with _lock:
+            for key in [key for key, (_, updated) in _buckets.items() if updated < full_before]:
+                del _buckets[key]
+    else:
+        connection().execute('DELETE FROM buckets WHERE updated < ?', [full_before])
+
+
+def take(client, resource_uid):
+    """
+    takes a token from the bucket of the client and then of the resource, returns None if both had one left,
+    or the seconds until the empty bucket has a token again
+    """
+    return take_scopes([('ip', client), ('resource', resource_uid)])
+
+
+def take_scopes(buckets):
+    """
+    takes a token from every (scope, key) bucket in order, stops at the first empty one and returns the seconds
+    until it has a token again, or None
+    """
+    if not OPTIONS['enabled']:
+        return None
+    now = time.time()
+    take_from = take_local if OPTIONS['path'] is None else take_shared
+    for (scope, key) in buckets:
+        limit = OPTIONS[scope]
+        retry_after = take_from(scope + ':' + key, limit['rate'], limit['burst'], now)
+        if retry_after is not None:
+            return retry_after
+    prune(now)
+    return None
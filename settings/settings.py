@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+import json
+import logging
+import os
+import signal
+import threading
+import time
+
+CONFIG_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + '/config.json'
+CHECK_INTERVAL = 1  # seconds between two checks of the modification time of the file
+
+# every configuration needs at least these (section, key) pairs
+REQUIRED = [
+    ('auth', 'username'),
+    ('auth', 'password'),
+    ('discord', 'inbox-webhook'),
+    ('mailjet', 'public_key'),
+    ('mailjet', 'private_key'),
+    ('mailjet', 'version'),
+]
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_current = None  # (modification time, configuration)
+_checked = 0
+_reload_requested = False
+
+
+def load(path):
+    with open(path, 'r') as file:
+        config = json.load(file)
+    for section, key in REQUIRED:
+        if not isinstance(config.get(section), dict) or not isinstance(config[section].get(key), str):
+            raise ValueError('Invalid Configuration: ' + section + '.' + key + ' is missing')
+    return config
+
+
+def current():
+    """
+    returns the loaded configuration, the file is only read again once it has been modified (or on SIGHUP)
+    """
+    global _current, _checked, _reload_requested
+    now = time.monotonic()
+    if _current is not None and not _reload_requested and now - _checked < CHECK_INTERVAL:
+        return _current[1]
+    with _lock:
+        _checked = now
+        modified = os.stat(CONFIG_PATH).st_mtime_ns
+        if _current is None:
+            _current = (modified, load(CONFIG_PATH))
+        elif _reload_requested or modified != _current[0]:
+            _reload_requested = False
+            try:
+                _current = (modified, load(CONFIG_PATH))
+                logger.info('configuration reloaded')
+            except (OSError, ValueError) as error:  # e.g. the file is just being written, keep the previous one
+                logger.error('reloading the configuration failed: %r', error)
+        return _current[1]
+
+
+def request_reload(*_args):
+    global _reload_requested
+    _reload_requested = True
+
+
+def install_signal_handler():
+    try:
+        signal.signal(signal.SIGHUP, request_reload)
+    except (ValueError, AttributeError):
+        pass  # not the main thread (e.g. mod_wsgi) or no SIGHUP on this platform, the modification time still works
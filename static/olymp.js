@@ -230,9 +230,11 @@ class Olymp {
     }
   }
 
-  async entriesList(resourceUid) {
+  async entriesList(resourceUid, latest = false) {
     Olymp._verify(Olymp._verifyUid(resourceUid));
-    const path = `${this.server}/resources/${resourceUid}/entries`;
+    // latest: the server only returns the most recent entry per identification
+    const query = latest ? "?latest=true" : "";
+    const path = `${this.server}/resources/${resourceUid}/entries${query}`;
     const credentials = this.username !== null && this.password !== null;
     const [text, status] = credentials
       ? await HTTP.getWithAuthorization(path, this.username, this.password)
@@ -5,11 +5,163 @@ import os
 import sqlite3
 import secrets
 import datetime
+import threading
+import sys
+import collections
+import contextlib
+import functools
+import re
+import time
+import zlib
 
 LENGTH_OF_UID = 32
 STORAGE_PATH = os.path.dirname(os.path.abspath(__file__))
 DB_PATH = STORAGE_PATH + '/database.sqlite3'
 
+# can be overwritten by the 'storage' section in config.json, see configure()
+DB_OPTIONS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,  # milliseconds
+    'indexed_fields': [],  # (column, key) pairs of body fields to create an index for, e.g. ('public_body', 'rounds')
+    'compact_interval': 0,  # seconds between moving superseded revisions into the history, 0 only by 'compact'
+}
+
+JOURNAL_MODES = ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF')
+SYNCHRONOUS_LEVELS = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+_local = threading.local()
+_generation = 0
+
+# called with the changed scope after every committed write, e.g. to invalidate caches
+listeners = []
+
+# called with the name of a storage function and the seconds it took, e.g. to export metrics
+timings = []
+
+# every migration is a list of statements, applied once and in order to existing databases,
+# 'PRAGMA user_version' stores the number of migrations already applied, never change or remove a released migration
+MIGRATIONS = [
+    # 1: listing the entries of a resource and looking up the entries of an identification
+    [
+        'CREATE INDEX IF NOT EXISTS entries_resource_timestamp ON entries (resource_uid, timestamp)',
+        'CREATE INDEX IF NOT EXISTS entries_resource_identification_timestamp ON entries (resource_uid, identification, timestamp)',
+    ],
+    # 2: keyset pagination over (timestamp, entry_uid)
+    [
+        'DROP INDEX IF EXISTS entries_resource_timestamp',
+        'CREATE INDEX IF NOT EXISTS entries_resource_timestamp_entry ON entries (resource_uid, timestamp, entry_uid)',
+    ],
+    # 3: notifications (mails, discord messages) which still have to be sent, see mail/outbox.py
+    [
+        '''CREATE TABLE IF NOT EXISTS outbox (
+            outbox_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            resource_uid TEXT NOT NULL,
+            entry_uid TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt TEXT NOT NULL,
+            last_error TEXT NOT NULL DEFAULT ''
+        )''',
+        'CREATE INDEX IF NOT EXISTS outbox_attempts_next_attempt ON outbox (attempts, next_attempt)',
+    ],
+    # 4: a counter per resource bumped on every write, used to answer conditional requests without reading the rows
+    [
+        '''CREATE TABLE IF NOT EXISTS changes (
+            scope TEXT PRIMARY KEY,
+            version INTEGER NOT NULL,
+            timestamp TEXT NOT NULL
+        )''',
+        '''INSERT OR IGNORE INTO changes (scope, version, timestamp)
+            SELECT resource_uid, COUNT(*), MAX(timestamp) FROM entries GROUP BY resource_uid''',
+        '''INSERT OR IGNORE INTO changes (scope, version, timestamp)
+            SELECT 'resources', COUNT(*), MAX(timestamp) FROM resources HAVING COUNT(*) > 0''',
+    ],
+    # 5: a strictly increasing sequence number per entry, the rowid is not stable (VACUUM may renumber it)
+    [
+        'ALTER TABLE entries ADD COLUMN sequence INTEGER',
+        'UPDATE entries SET sequence = rowid',
+        'CREATE UNIQUE INDEX IF NOT EXISTS entries_sequence ON entries (sequence)',
+        'CREATE INDEX IF NOT EXISTS entries_resource_sequence ON entries (resource_uid, sequence)',
+    ],
+    # 6: full text search over the entries, kept up to date by triggers, the decoded values of the bodies are indexed
+    # instead of the JSON text (its keys and escaped umlauts would be found otherwise)
+    [
+        'CREATE VIRTUAL TABLE IF NOT EXISTS entries_search USING fts5(identification, public_body, private_body)',
+        '''CREATE TRIGGER IF NOT EXISTS entries_search_insert AFTER INSERT ON entries BEGIN
+            INSERT INTO entries_search (rowid, identification, public_body, private_body) VALUES (
+                new.sequence,
+                new.identification,
+                CASE WHEN json_valid(new.public_body) THEN (
+                    SELECT group_concat(value, ' ') FROM json_tree(new.public_body) WHERE type IN ('text', 'integer', 'real')
+                ) ELSE new.public_body END,
+                CASE WHEN json_valid(new.private_body) THEN (
+                    SELECT group_concat(value, ' ') FROM json_tree(new.private_body) WHERE type IN ('text', 'integer', 'real')
+                ) ELSE new.private_body END
+            );
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS entries_search_delete AFTER DELETE ON entries BEGIN
+            DELETE FROM entries_search WHERE rowid = old.sequence;
+        END''',
+        '''INSERT INTO entries_search (rowid, identification, public_body, private_body)
+            SELECT
+                sequence,
+                identification,
+                CASE WHEN json_valid(public_body) THEN (
+                    SELECT group_concat(value, ' ') FROM json_tree(public_body) WHERE type IN ('text', 'integer', 'real')
+                ) ELSE public_body END,
+                CASE WHEN json_valid(private_body) THEN (
+                    SELECT group_concat(value, ' ') FROM json_tree(private_body) WHERE type IN ('text', 'integer', 'real')
+                ) ELSE private_body END
+            FROM entries''',
+    ],
+    # 7: superseded revisions moved out of entries, see entries_compact(), the body holds the remaining columns compressed
+    [
+        '''CREATE TABLE IF NOT EXISTS entries_history (
+            resource_uid TEXT NOT NULL,
+            entry_uid TEXT UNIQUE NOT NULL,
+            timestamp TEXT NOT NULL,
+            identification TEXT NOT NULL,
+            sequence INTEGER NOT NULL,
+            body BLOB NOT NULL
+        )''',
+        'CREATE INDEX IF NOT EXISTS entries_history_resource_identification ON entries_history (resource_uid, identification, timestamp)',
+    ],
+]
+
+HISTORY_BATCH_SIZE = 500  # revisions moved within a single transaction, writers are blocked meanwhile
+
+# only the most recent entry per identification of the resource (the parameter), entries without an identification
+# are never merged, the newer entry is looked up per row with the index on (resource_uid, identification, timestamp),
+# so a page sorted by timestamp stops after its limit instead of sorting the whole resource
+LATEST_ENTRIES_SQL = '''
+    (
+        SELECT * FROM entries AS entry WHERE resource_uid = ? AND (entry.identification = '' OR NOT EXISTS (
+            SELECT 1 FROM entries AS newer
+            WHERE newer.resource_uid = entry.resource_uid AND newer.identification = entry.identification AND newer.timestamp >= entry.timestamp
+                AND (newer.timestamp > entry.timestamp OR newer.entry_uid > entry.entry_uid)
+        ))
+    )
+'''
+
+# the columns a search may look into, depending on whether the request is authenticated
+SEARCH_COLUMNS_PUBLIC = ['public_body']
+SEARCH_COLUMNS_ALL = ['identification', 'public_body', 'private_body']
+
+BODY_COLUMNS = ('public_body', 'private_body')
+FIELD_KEY = re.compile('^[A-Za-z0-9_-]+$')  # keys are part of the SQL, so only allow harmless characters
+
+# scope of the changes of the resources themselves, the entries of a resource use the resource_uid as scope
+RESOURCES_SCOPE = 'resources'
+
+# comparison of the cursor and direction of the sorting
+ORDERS = {
+    'asc': ('>', 'ASC'),
+    'desc': ('<', 'DESC'),
+}
+
 
 def generate_uid():
     return secrets.token_hex(LENGTH_OF_UID)
@@ -25,61 +177,554 @@ def verify_uid(uid):
     int(uid, 16)
 
 
-def entries_add(resource_uid, identification, public_body, private_body, url, user_agent):
+def _timed(fun):
+    """
+    decorator reports the duration of a storage function to the timings, the functions returning a cursor
+    are only measured until the query was executed, never decorate a function calling another decorated one
+    """
+
+    @functools.wraps(fun)
+    def timed(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return fun(*args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - started
+            for timing in timings:
+                timing(fun.__name__, seconds)
+
+    return timed
+
+
+@_timed
+def entries_add(resource_uid, identification, public_body, private_body, url, user_agent, notifications=()):
+    """
+    notifications are (kind, payload) pairs, stored in the outbox within the same transaction as the entry
+    """
     verify_uid(resource_uid)
 
     entry_uid = generate_uid()
     timestamp = generate_timestamp()
 
     insert_entry_sql = '''
-        INSERT INTO entries (resource_uid, entry_uid, timestamp, identification, public_body, private_body, url, user_agent) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        INSERT INTO entries (resource_uid, entry_uid, timestamp, identification, public_body, private_body, url, user_agent, sequence) VALUES (?, ?, ?, ?, ?, ?, ?, ?, (SELECT COALESCE(MAX(sequence), 0) + 1 FROM entries))
+    '''
+    insert_outbox_sql = '''
+        INSERT INTO outbox (kind, resource_uid, entry_uid, payload, timestamp, next_attempt) VALUES (?, ?, ?, ?, ?, ?)
     '''
 
-    conn, cur = connect(DB_PATH)
-    cur.execute(insert_entry_sql,
-                [resource_uid, entry_uid, timestamp, identification, public_body, private_body, url, user_agent])
-    conn.commit()
-    conn.close()
+    with transaction() as (conn, cur):
+        cur.execute(insert_entry_sql,
+                    [resource_uid, entry_uid, timestamp, identification, public_body, private_body, url, user_agent])
+        cur.executemany(insert_outbox_sql,
+                        [[kind, resource_uid, entry_uid, payload, timestamp, timestamp] for (kind, payload) in notifications])
+        _changes_bump(cur, resource_uid, timestamp)
+    _changed(resource_uid)
 
     return {'uid': entry_uid, 'timestamp': timestamp}
 
 
-def entries_list(resource_uid):
+@_timed
+def entries_add_many(resource_uid, entries):
+    """
+    adds all entries, given as (identification, public_body, private_body, url, user_agent, timestamp) tuples,
+    within a single transaction, a timestamp of None is replaced by the current time
+    """
+    verify_uid(resource_uid)
+
+    rows = []
+    results = []
+    for (identification, public_body, private_body, url, user_agent, timestamp) in entries:
+        entry_uid = generate_uid()
+        timestamp = generate_timestamp() if timestamp is None else timestamp
+        rows.append([resource_uid, entry_uid, timestamp, identification, public_body, private_body, url, user_agent])
+        results.append({'uid': entry_uid, 'timestamp': timestamp})
+    if not rows:
+        return results
+
+    insert_entry_sql = '''
+        INSERT INTO entries (resource_uid, entry_uid, timestamp, identification, public_body, private_body, url, user_agent, sequence) VALUES (?, ?, ?, ?, ?, ?, ?, ?, (SELECT COALESCE(MAX(sequence), 0) + 1 FROM entries))
+    '''
+
+    with transaction() as (conn, cur):
+        cur.executemany(insert_entry_sql, rows)
+        _changes_bump(cur, resource_uid, generate_timestamp(), len(rows))
+    _changed(resource_uid)
+
+    return results
+
+
+def _changes_bump(cur, scope, timestamp, count=1):
+    bump_changes_sql = '''
+        INSERT INTO changes (scope, version, timestamp) VALUES (?, ?, ?)
+        ON CONFLICT (scope) DO UPDATE SET version = version + excluded.version, timestamp = excluded.timestamp
+    '''
+    cur.execute(bump_changes_sql, [scope, count, timestamp])
+
+
+def _changed(scope):
+    for listener in listeners:
+        listener(scope)
+
+
+@_timed
+def changes_get(scope):
+    """
+    returns the number of writes and the timestamp of the last write, (0, None) if there was none yet
+    """
+    conn, cur = connection()
+    cur.execute('SELECT version, timestamp FROM changes WHERE scope = ?', [scope])
+    result = cur.fetchone()
+    return result if result is not None else (0, None)
+
+
+def entries_cursor(entry):
+    """
+    the cursor to continue after the entry, it stays valid even if the entry was moved into the history
+    """
+    return entry[2] + ',' + entry[1]
+
+
+def _cursor(after):
+    """
+    (timestamp, entry_uid) of a cursor from entries_cursor() or of the entry_uid of an existing entry
+    """
+    if ',' in after:
+        timestamp, entry_uid = after.rsplit(',', 1)
+        datetime.datetime.fromisoformat(timestamp)  # raises for invalid cursors
+        return [timestamp, entry_uid]
+    conn, cur = connection()
+    cur.execute('SELECT timestamp, entry_uid FROM entries WHERE entry_uid = ? UNION ALL SELECT timestamp, entry_uid FROM entries_history WHERE entry_uid = ?',
+                [after, after])
+    row = cur.fetchone()
+    if row is None:
+        raise ValueError('Invalid Cursor')  # an empty page would look like the end
+    return list(row)
+
+
+def _page_sql(limit, after, order, start=None, end=None):
+    """
+    keyset pagination, 'after' is the cursor (or entry_uid) of the last entry of the previous page,
+    start (inclusive) and end (exclusive) limit the timestamps
+    """
+    if order not in ORDERS:
+        raise ValueError('Invalid Order')
+    if limit is not None and limit < 1:
+        raise ValueError('Invalid Limit')
+    comparison, direction = ORDERS[order]
+    where_sql = ''
+    params = []
+    if after is not None:
+        where_sql = ' AND (timestamp, entry_uid) ' + comparison + ' (?, ?)'
+        params.extend(_cursor(after))
+    if start is not None:
+        where_sql += ' AND timestamp >= ?'
+        params.append(start)
+    if end is not None:
+        where_sql += ' AND timestamp < ?'
+        params.append(end)
+    order_sql = ' ORDER BY timestamp ' + direction + ', entry_uid ' + direction
+    if limit is not None:
+        order_sql += ' LIMIT ?'
+        params.append(limit)
+    return where_sql, order_sql, params
+
+
+@_timed
+def entries_iter(resource_uid, limit=None, after=None, order='asc', start=None, end=None):
+    verify_uid(resource_uid)
+
+    where_sql, order_sql, page_params = _page_sql(limit, after, order, start, end)
+    select_resource_sql = '''
+        SELECT resource_uid, entry_uid, timestamp, identification, public_body, private_body, url, user_agent FROM entries WHERE resource_uid = ?
+    ''' + where_sql + order_sql
+
+    conn, cur = connection()
+    cur.execute(select_resource_sql, [resource_uid] + page_params)
+
+    return cur  # rows are only fetched while iterating over the cursor
+
+
+def entries_list(resource_uid, limit=None, after=None, order='asc', start=None, end=None):
+    return entries_iter(resource_uid, limit, after, order, start, end).fetchall()
+
+
+@_timed
+def entries_iter_latest(resource_uid, limit=None, after=None, order='asc', start=None, end=None):
     verify_uid(resource_uid)
 
+    where_sql, order_sql, page_params = _page_sql(limit, after, order, start, end)
     select_resource_sql = '''
-        SELECT resource_uid, entry_uid, timestamp, identification, public_body, private_body, url, user_agent FROM entries WHERE resource_uid = ? ORDER BY timestamp
+        SELECT resource_uid, entry_uid, timestamp, identification, public_body, private_body, url, user_agent FROM
+    ''' + LATEST_ENTRIES_SQL + ' WHERE 1' + where_sql + order_sql
+
+    conn, cur = connection()
+    cur.execute(select_resource_sql, [resource_uid] + page_params)
+
+    return cur
+
+
+def entries_list_latest(resource_uid, limit=None, after=None, order='asc', start=None, end=None):
+    return entries_iter_latest(resource_uid, limit, after, order, start, end).fetchall()
+
+
+@_timed
+def entries_body_keys(resource_uid):
+    """
+    returns all top level keys used in the public and in the private bodies of the entries of a resource
+    """
+    verify_uid(resource_uid)
+
+    select_keys_sql = '''
+        SELECT DISTINCT key FROM entries, json_each(entries.{body}) WHERE resource_uid = ? AND json_type(entries.{body}) = 'object' ORDER BY key
     '''
 
-    conn, cur = connect(DB_PATH)
-    cur.execute(select_resource_sql, [resource_uid])
+    conn, cur = connection()
+    cur.execute(select_keys_sql.format(body='public_body'), [resource_uid])
+    public_keys = [key for (key,) in cur.fetchall()]
+    cur.execute(select_keys_sql.format(body='private_body'), [resource_uid])
+    private_keys = [key for (key,) in cur.fetchall()]
+
+    return public_keys, private_keys
+
+
+def _field_sql(column, key, table='', function='json_extract'):
+    if column not in BODY_COLUMNS or not FIELD_KEY.match(key):
+        raise ValueError('Invalid Field')
+    return function + '(' + table + column + ', \'$."' + key + '"\')'
+
+
+def _field_values(value):
+    """
+    the value of a filter as text and decoded as JSON, e.g. 1 matches the number as well as the text '1'
+    """
+    try:
+        decoded = json.loads(value)
+    except ValueError:
+        return [value, value]
+    if isinstance(decoded, bool):
+        decoded = int(decoded)  # json_extract() returns true as 1
+    return [value, decoded if isinstance(decoded, (str, int, float)) else value]
+
+
+def _field_match(resource_uid, column, key, value):
+    """
+    the condition and its parameters for a body field equal to the value, or an array containing it,
+    an indexed field is looked up with its indexes on the value and on the type
+    """
+    values = _field_values(value)
+    element_sql = '(' + _field_sql(column, key, 'entries.', 'json_type') + ' = \'array\' AND EXISTS (SELECT 1 FROM ' + _field_sql(column, key, 'entries.', 'json_each') + ' WHERE json_each.value IN (?, ?)))'
+    if (column, key) not in DB_OPTIONS['indexed_fields']:
+        return '(' + _field_sql(column, key, 'entries.') + ' IN (?, ?) OR ' + element_sql + ')', values + values
+    # every part of the OR has to start with the resource, so that both are looked up with an index
+    match_sql = 'entries.sequence IN (SELECT sequence FROM entries WHERE (resource_uid = ? AND ' + _field_sql(column, key, 'entries.') + ' IN (?, ?)) OR (resource_uid = ? AND ' + element_sql + '))'
+    return match_sql, [resource_uid] + values + [resource_uid] + values
+
+
+def _search_match(query, columns):
+    """
+    every word of the query has to appear within the given columns, a trailing * matches any word with this prefix
+    """
+    terms = []
+    for word in query.split():
+        prefix = word.endswith('*')
+        word = word.rstrip('*')
+        if word:
+            terms.append('"' + word.replace('"', '""') + '"' + ('*' if prefix else ''))
+    if not terms:
+        return None
+    return '{' + ' '.join(columns) + '} : (' + ' '.join(terms) + ')'
+
+
+@_timed
+def entries_search(resource_uid, query='', columns=SEARCH_COLUMNS_PUBLIC, fields=(), limit=100):
+    """
+    entries matching the full text query within the columns and with body fields (column, key, value) equal to the value
+    or arrays containing it, the best matches first if there is a query, the oldest first otherwise
+    """
+    verify_uid(resource_uid)
+
+    match = _search_match(query, columns)
+    where_sql = ''
+    params = []
+    for (column, key, value) in fields:
+        field_sql, field_params = _field_match(resource_uid, column, key, value)
+        where_sql += ' AND ' + field_sql
+        params.extend(field_params)
+
+    if match is None:
+        select_entries_sql = '''
+            SELECT resource_uid, entry_uid, timestamp, identification, public_body, private_body, url, user_agent FROM entries WHERE resource_uid = ?
+        ''' + where_sql + ' ORDER BY timestamp, entry_uid LIMIT ?'
+        params = [resource_uid] + params + [limit]
+    else:
+        select_entries_sql = '''
+            SELECT entries.resource_uid, entries.entry_uid, entries.timestamp, entries.identification, entries.public_body, entries.private_body, entries.url, entries.user_agent
+            FROM entries_search JOIN entries ON entries.sequence = entries_search.rowid WHERE entries_search MATCH ? AND entries.resource_uid = ?
+        ''' + where_sql + ' ORDER BY entries_search.rank LIMIT ?'
+        params = [match, resource_uid] + params + [limit]
+
+    conn, cur = connection()
+    cur.execute(select_entries_sql, params)
+    results = cur.fetchall()
+
+    return results
+
+
+@_timed
+def entries_aggregate(resource_uid, group, latest=True):
+    """
+    counts the entries per value of a body field (column, key), every element of an array is counted on its own,
+    or per day if group is 'day', returns (value, count) pairs ordered by value
+    """
+    verify_uid(resource_uid)
+
+    source_sql = LATEST_ENTRIES_SQL if latest else '(SELECT * FROM entries WHERE resource_uid = ?)'
+    if group == 'day':
+        aggregate_sql = 'SELECT substr(timestamp, 1, 10) AS value, COUNT(*) FROM ' + source_sql + ' GROUP BY value ORDER BY value'
+    else:
+        (column, key) = group
+        _field_sql(column, key)  # raises for invalid fields
+        aggregate_sql = 'SELECT value, COUNT(*) FROM ' + source_sql + ' AS source, json_each(source.' + column + ', \'$."' + key + '"\') GROUP BY value ORDER BY value'
+
+    conn, cur = connection()
+    cur.execute(aggregate_sql, [resource_uid])
     results = cur.fetchall()
-    conn.close()
 
     return results
 
 
+@_timed
+def entries_iter_since(resource_uid, since, limit=None):
+    """
+    entries written after the entry with the sequence number 'since', the sequence number is appended to every row
+    """
+    verify_uid(resource_uid)
+
+    select_resource_sql = '''
+        SELECT resource_uid, entry_uid, timestamp, identification, public_body, private_body, url, user_agent, sequence FROM entries WHERE resource_uid = ? AND sequence > ? ORDER BY sequence LIMIT ?
+    '''
+
+    conn, cur = connection()
+    cur.execute(select_resource_sql, [resource_uid, since, -1 if limit is None else limit])
+
+    return cur
+
+
+def entries_list_since(resource_uid, since, limit=None):
+    return entries_iter_since(resource_uid, since, limit).fetchall()
+
+
+@_timed
+def entries_latest(resource_uid, identification):
+    verify_uid(resource_uid)
+
+    select_entry_sql = '''
+        SELECT resource_uid, entry_uid, timestamp, identification, public_body, private_body, url, user_agent FROM entries WHERE resource_uid = ? AND identification = ? ORDER BY timestamp DESC, entry_uid DESC LIMIT 1
+    '''
+
+    conn, cur = connection()
+    cur.execute(select_entry_sql, [resource_uid, identification])
+    result = cur.fetchone()
+
+    return result
+
+
+@_timed
 def entries_get(resource_uid, entry_uid):
-    all_entries_raw = entries_list(resource_uid)
-    return list(entry for entry in all_entries_raw if entry[1] == entry_uid)
+    verify_uid(resource_uid)
+
+    # entry_uid is UNIQUE and therefore already indexed
+    select_entry_sql = '''
+        SELECT resource_uid, entry_uid, timestamp, identification, public_body, private_body, url, user_agent FROM entries WHERE entry_uid = ? AND resource_uid = ?
+    '''
+
+    conn, cur = connection()
+    cur.execute(select_entry_sql, [entry_uid, resource_uid])
+    result = cur.fetchone()
+    if result is None:  # links to an entry stay valid after it was moved into the history
+        cur.execute('SELECT resource_uid, entry_uid, timestamp, identification, body FROM entries_history WHERE entry_uid = ? AND resource_uid = ?',
+                    [entry_uid, resource_uid])
+        archived = cur.fetchone()
+        result = None if archived is None else _history_entry(archived)
+
+    return result
+
+
+def _history_body(public_body, private_body, url, user_agent):
+    return zlib.compress(json.dumps([public_body, private_body, url, user_agent]).encode())
+
+
+def _history_entry(row):
+    """
+    the row of the history as an entry, (resource_uid, entry_uid, timestamp, identification, body)
+    """
+    (resource_uid, entry_uid, timestamp, identification, body) = row
+    return (resource_uid, entry_uid, timestamp, identification) + tuple(json.loads(zlib.decompress(body)))
+
+
+@_timed
+def entries_history(resource_uid, identification):
+    """
+    all revisions of an identification, the current entries and those moved into the history, oldest first
+    """
+    verify_uid(resource_uid)
+
+    select_entries_sql = '''
+        SELECT resource_uid, entry_uid, timestamp, identification, public_body, private_body, url, user_agent FROM entries WHERE resource_uid = ? AND identification = ?
+    '''
+    select_history_sql = '''
+        SELECT resource_uid, entry_uid, timestamp, identification, body FROM entries_history WHERE resource_uid = ? AND identification = ?
+    '''
+
+    conn, cur = connection()
+    cur.execute(select_history_sql, [resource_uid, identification])
+    results = [_history_entry(row) for row in cur.fetchall()]
+    cur.execute(select_entries_sql, [resource_uid, identification])
+    results.extend(cur.fetchall())
+
+    return sorted(results, key=lambda entry: (entry[2], entry[1]))
+
+
+@_timed
+def entries_compact(limit=HISTORY_BATCH_SIZE):
+    """
+    moves up to limit superseded revisions (a newer entry with the same identification exists) into the compressed
+    entries_history, the latest entries stay untouched, returns the number of moved revisions
+    """
+    # the entry with the highest sequence always stays, the next sequence is derived from it
+    select_superseded_sql = '''
+        SELECT resource_uid, entry_uid, timestamp, identification, public_body, private_body, url, user_agent, sequence FROM entries AS entry
+        WHERE identification != '' AND sequence < (SELECT MAX(sequence) FROM entries) AND EXISTS (
+            SELECT 1 FROM entries AS newer WHERE newer.resource_uid = entry.resource_uid AND newer.identification = entry.identification AND newer.timestamp > entry.timestamp
+        ) LIMIT ?
+    '''
+    insert_history_sql = '''
+        INSERT INTO entries_history (resource_uid, entry_uid, timestamp, identification, sequence, body) VALUES (?, ?, ?, ?, ?, ?)
+    '''
+
+    timestamp = generate_timestamp()
+    with transaction() as (conn, cur):
+        cur.execute(select_superseded_sql, [limit])
+        rows = cur.fetchall()
+        cur.executemany(insert_history_sql, [
+            [resource_uid, entry_uid, entry_timestamp, identification, sequence,
+             _history_body(public_body, private_body, url, user_agent)]
+            for (resource_uid, entry_uid, entry_timestamp, identification, public_body, private_body, url, user_agent, sequence) in rows])
+        cur.executemany('DELETE FROM entries WHERE entry_uid = ?', [[row[1]] for row in rows])  # triggers update the search
+        moved = collections.Counter(row[0] for row in rows)
+        for resource_uid, count in moved.items():
+            _changes_bump(cur, resource_uid, timestamp, count)
+    for resource_uid in moved:
+        _changed(resource_uid)
+
+    return len(rows)
+
+
+def compact(batch_size=HISTORY_BATCH_SIZE):
+    """
+    moves all superseded revisions into the history, in batches to let other writers in between,
+    returns the number of moved revisions
+    """
+    moved = 0
+    while True:
+        count = entries_compact(batch_size)
+        moved += count
+        if count < batch_size:
+            break
+    if moved:
+        vacuum()
+    return moved
+
+
+def vacuum(full=False):
+    """
+    returns free pages to the file system, incrementally once the database uses auto_vacuum = INCREMENTAL,
+    a full VACUUM rewrites the whole file (and switches to INCREMENTAL), all writers are blocked meanwhile
+    """
+    conn, cur = connection()
+    if full:
+        cur.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        cur.execute('VACUUM')
+    else:
+        cur.execute('PRAGMA incremental_vacuum').fetchall()  # every step frees one page, does nothing without auto_vacuum
+
+
+def configure(options):
+    global DB_PATH, _generation
+    journal_mode = options.get('journal_mode', DB_OPTIONS['journal_mode']).upper()
+    synchronous = options.get('synchronous', DB_OPTIONS['synchronous']).upper()
+    if journal_mode not in JOURNAL_MODES:
+        raise ValueError('Invalid Journal Mode')
+    if synchronous not in SYNCHRONOUS_LEVELS:
+        raise ValueError('Invalid Synchronous Level')
+    DB_OPTIONS['journal_mode'] = journal_mode
+    DB_OPTIONS['synchronous'] = synchronous
+    DB_OPTIONS['busy_timeout'] = int(options.get('busy_timeout', DB_OPTIONS['busy_timeout']))
+    indexed_fields = [tuple(field) for field in options.get('indexed_fields', DB_OPTIONS['indexed_fields'])]
+    for (column, key) in indexed_fields:
+        _field_sql(column, key)  # raises for invalid fields
+    DB_OPTIONS['indexed_fields'] = indexed_fields
+    DB_OPTIONS['compact_interval'] = float(options.get('compact_interval', DB_OPTIONS['compact_interval']))
+    DB_PATH = options.get('path', DB_PATH)
+    _generation += 1  # connections opened with the old options get replaced on their next use
+
 
 def connect(path):
-    conn = sqlite3.connect(path, isolation_level=None)
+    conn = sqlite3.connect(path, isolation_level=None, timeout=DB_OPTIONS['busy_timeout'] / 1000)
     cur = conn.cursor()
     cur.execute('PRAGMA foreign_keys = ON')  # due to backward compatibility sqlite disabled foreign keys by default
+    cur.execute('PRAGMA busy_timeout = ' + str(DB_OPTIONS['busy_timeout']))
+    cur.execute('PRAGMA journal_mode = ' + DB_OPTIONS['journal_mode'])
+    cur.execute('PRAGMA synchronous = ' + DB_OPTIONS['synchronous'])
     return conn, cur
 
 
+def connection():
+    """
+    returns a connection which is kept open and reused by the current thread (and process)
+    """
+    key = (os.getpid(), DB_PATH, _generation)
+    cached = getattr(_local, 'connection', None)
+    if cached is None or cached[0] != key:
+        if cached is not None and cached[0][0] == key[0]:
+            cached[1].close()  # never close a connection inherited from the parent process after a fork
+        conn, _ = connect(DB_PATH)
+        _local.connection = (key, conn)
+        cached = _local.connection
+    conn = cached[1]
+    return conn, conn.cursor()
+
+
+@contextlib.contextmanager
+def transaction():
+    """
+    everything executed within the block is committed at once, or not at all
+    """
+    conn, cur = connection()
+    cur.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn, cur
+    except BaseException:
+        cur.execute('ROLLBACK')
+        raise
+    cur.execute('COMMIT')
+
+
 # TODO maybe remove this in the future, or add a special parameter to not accidentaly run this?
 def drop():
     drop_tables_sql = '''
+        DROP TABLE IF EXISTS entries_history;
+        DROP TABLE IF EXISTS entries_search;
+        DROP TABLE IF EXISTS changes;
+        DROP TABLE IF EXISTS outbox;
         DROP TABLE IF EXISTS entries;
         DROP TABLE IF EXISTS resources;
+        PRAGMA user_version = 0;
     '''
 
-    conn, cur = connect(DB_PATH)
+    conn, cur = connection()
     cur.executescript(drop_tables_sql)
-    conn.close()
 
 
 def create():
@@ -105,48 +750,155 @@ def create():
         );
     '''
 
-    conn, cur = connect(DB_PATH)
+    conn, cur = connection()
     cur.executescript(create_tables_sql)
-    conn.close()
+    migrate()
+    create_field_indexes()
+
+
+def create_field_indexes():
+    """
+    the indexes are only used by queries built with _field_sql(), because the expression has to be identical,
+    the value of an array can not be indexed, only which entries hold an array in the field
+    """
+    conn, cur = connection()
+    for (column, key) in DB_OPTIONS['indexed_fields']:
+        index_name = 'entries_field_' + column + '_' + key.replace('-', '_')
+        cur.execute('CREATE INDEX IF NOT EXISTS ' + index_name + ' ON entries (resource_uid, ' + _field_sql(column, key) + ')')
+        cur.execute('CREATE INDEX IF NOT EXISTS ' + index_name + '_type ON entries (resource_uid, ' + _field_sql(column, key, '', 'json_type') + ')')
+
+
+def schema_version():
+    conn, cur = connection()
+    cur.execute('PRAGMA user_version')
+    return cur.fetchone()[0]
+
 
+def migrate():
+    """
+    applies all pending migrations, without touching existing data
+    """
+    if schema_version() >= len(MIGRATIONS):
+        return
+    for version, statements in enumerate(MIGRATIONS, start=1):
+        with transaction() as (conn, cur):  # another worker could be migrating at the same time
+            cur.execute('PRAGMA user_version')
+            if cur.fetchone()[0] < version:
+                for statement in statements:
+                    cur.execute(statement)
+                cur.execute('PRAGMA user_version = ' + str(version))
 
+
+@_timed
+def outbox_due(now, max_attempts, limit):
+    select_outbox_sql = '''
+        SELECT outbox_id, kind, resource_uid, entry_uid, payload, attempts, next_attempt FROM outbox WHERE attempts < ? AND next_attempt <= ? ORDER BY next_attempt LIMIT ?
+    '''
+
+    conn, cur = connection()
+    cur.execute(select_outbox_sql, [max_attempts, now, limit])
+    results = cur.fetchall()
+
+    return results
+
+
+@_timed
+def outbox_claim(outbox_id, next_attempt, lease_until):
+    """
+    only one dispatcher (of possibly many worker processes) succeeds in claiming a notification
+    """
+    claim_outbox_sql = '''
+        UPDATE outbox SET next_attempt = ? WHERE outbox_id = ? AND next_attempt = ?
+    '''
+
+    conn, cur = connection()
+    cur.execute(claim_outbox_sql, [lease_until, outbox_id, next_attempt])
+    return cur.rowcount == 1
+
+
+@_timed
+def outbox_done(outbox_id):
+    conn, cur = connection()
+    cur.execute('DELETE FROM outbox WHERE outbox_id = ?', [outbox_id])
+
+
+@_timed
+def outbox_retry(outbox_id, attempts, next_attempt, error, payload=None):
+    """
+    payload replaces the stored one if given, e.g. to only retry the part which failed
+    """
+    retry_outbox_sql = '''
+        UPDATE outbox SET attempts = ?, next_attempt = ?, last_error = ?, payload = COALESCE(?, payload) WHERE outbox_id = ?
+    '''
+
+    conn, cur = connection()
+    cur.execute(retry_outbox_sql, [attempts, next_attempt, error, payload, outbox_id])
+
+
+@_timed
 def resources_add(resource_uid, public_body, private_body, url, user_agent):
     timestamp = generate_timestamp()
     insert_resource_sql = '''
         INSERT INTO resources (resource_uid, timestamp, public_body, private_body, url, user_agent) VALUES (?, ?, ?, ?, ?, ?)
     '''
 
-    conn, cur = connect(DB_PATH)
-    cur.execute(insert_resource_sql, [resource_uid, timestamp, public_body, private_body, url, user_agent])
-    conn.close()
+    with transaction() as (conn, cur):
+        cur.execute(insert_resource_sql, [resource_uid, timestamp, public_body, private_body, url, user_agent])
+        _changes_bump(cur, RESOURCES_SCOPE, timestamp)
+    _changed(RESOURCES_SCOPE)
 
 
-def resources_list():
+@_timed
+def resources_iter():
     select_resource_sql = '''
         SELECT resource_uid, timestamp, public_body, private_body, url, user_agent FROM resources
     '''
 
-    conn, cur = connect(DB_PATH)
+    conn, cur = connection()
     cur.execute(select_resource_sql)
-    results = cur.fetchall()
-    conn.close()
 
-    return results
+    return cur
+
+
+def resources_list():
+    return resources_iter().fetchall()
 
 
+@_timed
 def resources_list_single(resource_uid):
-    all_resources = resources_list()
-    for resource in all_resources:
-        if resource_uid == resource[0]:
-            return resource
+    # resource_uid is UNIQUE and therefore already indexed
+    select_resource_sql = '''
+        SELECT resource_uid, timestamp, public_body, private_body, url, user_agent FROM resources WHERE resource_uid = ?
+    '''
+
+    conn, cur = connection()
+    cur.execute(select_resource_sql, [resource_uid])
+    result = cur.fetchone()
+
+    return result
 
 
 if __name__ == '__main__':
+    if sys.argv[1:] == ['migrate']:
+        create()
+        print('schema version', schema_version())
+        sys.exit(0)
+    if sys.argv[1:] == ['compact']:
+        create()
+        print('moved revisions', compact())
+        sys.exit(0)
+    if sys.argv[1:] == ['vacuum']:
+        create()
+        vacuum(full=True)
+        sys.exit(0)
+
     # TODO maybe make a backup first, once we run the hot version?
 
     drop()
     create()
 
+    assert schema_version() == len(MIGRATIONS)
+
     UID_EMPTY = 'ffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffff'
     UID_TEST = '0000000000000000000000000000000000000000000000000000000000000000'
 
@@ -155,6 +907,8 @@ if __name__ == '__main__':
     assert len(resources_list()) == 0
     resources_add(UID_TEST, '{}', '{}', '', '')
     assert len(resources_list()) == 1
+    assert resources_list_single(UID_TEST)[0] == UID_TEST
+    assert resources_list_single(UID_EMPTY) is None
 
     # test UID_TEST
 
@@ -165,10 +919,148 @@ if __name__ == '__main__':
     for i in range(N):
         entries_add(UID_TEST, generate_uid(), PUBLIC, PRIVATE, '', '')
     assert len(entries_list(UID_TEST)) == N
+    assert changes_get(UID_TEST)[0] == N
+    assert changes_get(UID_EMPTY) == (0, None)
+    assert changes_get(RESOURCES_SCOPE)[0] == 1
 
     assert entries_list(UID_TEST)[0][4] == PUBLIC
     assert entries_list(UID_TEST)[0][5] == PRIVATE
 
+    IDENTIFICATION = generate_uid()
+    assert entries_latest(UID_TEST, IDENTIFICATION) is None
+    entries_add(UID_TEST, IDENTIFICATION, '{"revision": 1}', PRIVATE, '', '')
+    entries_add(UID_TEST, IDENTIFICATION, '{"revision": 2}', PRIVATE, '', '')
+    assert entries_latest(UID_TEST, IDENTIFICATION)[4] == '{"revision": 2}'
+
+    latest = entries_list_latest(UID_TEST)
+    assert len(latest) == N + 1
+    assert latest[-1][3] == IDENTIFICATION
+    assert latest[-1][4] == '{"revision": 2}'
+
+    all_entries = entries_list(UID_TEST)
+    first_page = entries_list(UID_TEST, limit=2)
+    assert first_page == all_entries[:2]
+    assert entries_list(UID_TEST, limit=2, after=first_page[-1][1]) == all_entries[2:4]
+    assert entries_list(UID_TEST, order='desc') == all_entries[::-1]
+    assert entries_list(UID_TEST, after=all_entries[-1][1]) == []
+    assert entries_list(UID_TEST, limit=2, after=entries_cursor(first_page[-1])) == all_entries[2:4]
+    for invalid_cursor in (generate_uid(), 'no timestamp,' + generate_uid()):
+        try:
+            entries_list(UID_TEST, after=invalid_cursor)
+            assert False
+        except ValueError:
+            pass
+    assert list(entries_iter(UID_TEST)) == all_entries
+
+    NOW = generate_timestamp()
+    assert len(outbox_due(NOW, 1, 10)) == 0
+    entries_add(UID_TEST, '', PUBLIC, PRIVATE, '', '', [('test', '{}')])
+    [(OUTBOX_ID, KIND, _, _, PAYLOAD, ATTEMPTS, NEXT_ATTEMPT)] = outbox_due(generate_timestamp(), 1, 10)
+    assert outbox_claim(OUTBOX_ID, NEXT_ATTEMPT, '9999')
+    assert not outbox_claim(OUTBOX_ID, NEXT_ATTEMPT, '9999')
+    outbox_retry(OUTBOX_ID, 1, NOW, 'error')
+    assert len(outbox_due(generate_timestamp(), 1, 10)) == 0
+    outbox_done(OUTBOX_ID)
+
+    since = entries_list_since(UID_TEST, 0)
+    assert [entry[:8] for entry in since] == entries_list(UID_TEST)
+    assert entries_list_since(UID_TEST, since[-1][8]) == []
+    assert entries_list_since(UID_TEST, since[-3][8], 1) == since[-2:-1]
+
+    count = len(entries_list(UID_TEST))
+    version = changes_get(UID_TEST)[0]
+    added = entries_add_many(UID_TEST, [('', PUBLIC, PRIVATE, '', '', None), ('', PUBLIC, PRIVATE, '', '', '2000-01-01T00:00:00')])
+    assert len(entries_list(UID_TEST)) == count + 2
+    assert changes_get(UID_TEST)[0] == version + 2
+    assert entries_list(UID_TEST)[0][1] == added[1]['uid']
+    assert entries_add_many(UID_TEST, []) == []
+
+    assert entries_body_keys(UID_TEST) == (['a', 'revision'], ['b'])
+    assert len(entries_list(UID_TEST, start='2000-01-01T00:00:00', end='2000-01-02T00:00:00')) == 1
+
+    entries_add(UID_TEST, 'searchable', '{"name": "Gandalf der Graue"}', '{"email": "gandalf@mittelerde.ch"}', '', '')
+    assert len(entries_search(UID_TEST, 'gandalf')) == 1
+    assert len(entries_search(UID_TEST, 'mittelerde')) == 0
+    assert len(entries_search(UID_TEST, 'mittelerde', SEARCH_COLUMNS_ALL)) == 1
+    assert len(entries_search(UID_TEST, 'gand* grau*')) == 1
+    assert len(entries_search(UID_TEST, 'private_body : mittelerde')) == 0
+    assert len(entries_search(UID_TEST, fields=[('public_body', 'name', 'Gandalf der Graue')])) == 1
+    assert len(entries_search(UID_TEST, 'gandalf', fields=[('public_body', 'name', 'Saruman')])) == 0
+
+    DB_OPTIONS['indexed_fields'] = [('public_body', 'name')]
+    create_field_indexes()
+    conn, cur = connection()
+    cur.execute('EXPLAIN QUERY PLAN SELECT entry_uid FROM entries WHERE resource_uid = ? AND ' + _field_sql('public_body', 'name', 'entries.') + ' = ?', [UID_TEST, 'x'])
+    assert 'entries_field_public_body_name' in str(cur.fetchall())
+    cur.execute('EXPLAIN QUERY PLAN SELECT entry_uid FROM entries WHERE ' + _field_match(UID_TEST, 'public_body', 'name', 'x')[0], _field_match(UID_TEST, 'public_body', 'name', 'x')[1])
+    assert 'entries_field_public_body_name_type' in str(cur.fetchall())
+    assert len(entries_search(UID_TEST, fields=[('public_body', 'name', 'Gandalf der Graue')])) == 1
+
+    UID_AGGREGATE = '1111111111111111111111111111111111111111111111111111111111111111'
+    resources_add(UID_AGGREGATE, '{}', '{}', '', '')
+    entries_add(UID_AGGREGATE, 'a', '{"rounds": ["GM-0"]}', '{}', '', '')
+    entries_add(UID_AGGREGATE, 'a', '{"rounds": ["GM-0", "GM-1"]}', '{}', '', '')
+    entries_add(UID_AGGREGATE, 'b', '{"rounds": ["GM-1"]}', '{}', '', '')
+    entries_add(UID_AGGREGATE, 'c', '{"rounds": "GM-2"}', '{}', '', '')
+    assert entries_aggregate(UID_AGGREGATE, ('public_body', 'rounds')) == [('GM-0', 1), ('GM-1', 2), ('GM-2', 1)]
+    assert entries_aggregate(UID_AGGREGATE, ('public_body', 'rounds'), False) == [('GM-0', 2), ('GM-1', 2), ('GM-2', 1)]
+    assert entries_aggregate(UID_AGGREGATE, 'day')[0][1] == 3
+    entries_add(UID_AGGREGATE, 'd', '{"n": 1, "ok": true, "text": "1"}', '{}', '', '')
+    for indexed_fields in ([], [('public_body', 'rounds'), ('public_body', 'n')]):
+        DB_OPTIONS['indexed_fields'] = indexed_fields
+        create_field_indexes()
+        assert len(entries_search(UID_AGGREGATE, fields=[('public_body', 'rounds', 'GM-0')])) == 2
+        assert len(entries_search(UID_AGGREGATE, fields=[('public_body', 'rounds', 'GM-2')])) == 1
+        assert len(entries_search(UID_AGGREGATE, 'gm', fields=[('public_body', 'rounds', 'GM-1')])) == 2
+        assert len(entries_search(UID_AGGREGATE, fields=[('public_body', 'n', '1')])) == 1
+        assert len(entries_search(UID_AGGREGATE, fields=[('public_body', 'ok', 'true')])) == 1
+        assert len(entries_search(UID_AGGREGATE, fields=[('public_body', 'text', '1')])) == 1
+        assert len(entries_search(UID_AGGREGATE, fields=[('public_body', 'n', '2')])) == 0
+
+    # move superseded revisions into the history
+
+    UID_HISTORY = '2222222222222222222222222222222222222222222222222222222222222222'
+    resources_add(UID_HISTORY, '{}', '{}', '', '')
+    FIRST = entries_add(UID_HISTORY, 'h', '{"revision": 1}', '{}', 'url', 'agent')['uid']
+    entries_add(UID_HISTORY, 'h', '{"revision": 2}', '{"secret": "h"}', 'url', 'agent')
+    entries_add(UID_HISTORY, '', '{}', '{}', '', '')
+    LATEST_BEFORE = entries_list_latest(UID_HISTORY)
+    VERSION_BEFORE = changes_get(UID_HISTORY)[0]
+    assert compact() >= 1
+    assert entries_list_latest(UID_HISTORY) == LATEST_BEFORE
+    assert len(entries_list(UID_HISTORY)) == 2
+    assert changes_get(UID_HISTORY)[0] == VERSION_BEFORE + 1
+    assert entries_get(UID_HISTORY, FIRST)[4:] == ('{"revision": 1}', '{}', 'url', 'agent')
+    assert [entry[4] for entry in entries_history(UID_HISTORY, 'h')] == ['{"revision": 1}', '{"revision": 2}']
+    assert entries_search(UID_HISTORY, '2') == entries_list(UID_HISTORY)[:1]
+    assert compact() == 0
+
+    # the search finds decoded values, but never keys
+
+    UID_SEARCH = '3333333333333333333333333333333333333333333333333333333333333333'
+    resources_add(UID_SEARCH, '{}', '{}', '', '')
+    entries_add(UID_SEARCH, '', json.dumps({'name': 'Jürg Müller aus Zürich'}), '{}', '', '')
+    entries_add(UID_SEARCH, '', '"plain"', 'invalid json', '', '')
+    assert len(entries_search(UID_SEARCH, 'Müller')) == 1
+    assert len(entries_search(UID_SEARCH, 'Zürich Jürg')) == 1
+    assert len(entries_search(UID_SEARCH, 'name')) == 0
+    assert len(entries_search(UID_SEARCH, 'plain')) == 1
+    assert len(entries_search(UID_SEARCH, 'invalid', SEARCH_COLUMNS_ALL)) == 1
+
+    ENTRY_UID = entries_latest(UID_TEST, IDENTIFICATION)[1]
+    assert entries_get(UID_TEST, ENTRY_UID)[1] == ENTRY_UID
+    assert entries_get(UID_EMPTY, ENTRY_UID) is None
+    assert entries_get(UID_TEST, generate_uid()) is None
+
+    conn, cur = connection()
+    cur.execute('EXPLAIN QUERY PLAN SELECT entry_uid FROM entries WHERE resource_uid = ? ORDER BY timestamp, entry_uid', [UID_TEST])
+    assert 'entries_resource_timestamp_entry' in str(cur.fetchall())
+    cur.execute('EXPLAIN QUERY PLAN SELECT entry_uid FROM entries WHERE resource_uid = ? AND identification = ? ORDER BY timestamp DESC LIMIT 1', [UID_TEST, IDENTIFICATION])
+    assert 'entries_resource_identification_timestamp' in str(cur.fetchall())
+    cur.execute('EXPLAIN QUERY PLAN SELECT entry_uid FROM ' + LATEST_ENTRIES_SQL + ' ORDER BY timestamp, entry_uid LIMIT 100', [UID_TEST])
+    plan = str(cur.fetchall())
+    assert 'entries_resource_identification_timestamp' in plan and 'TEMP B-TREE' not in plan
+
     # test UID_EMPTY
 
     assert len(entries_list(UID_EMPTY)) == 0